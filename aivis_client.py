@@ -0,0 +1,312 @@
+import io
+import os
+import asyncio
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+# タイムアウト設定（秒）
+AIVIS_CONNECT_TIMEOUT = float(os.getenv("AIVIS_CONNECT_TIMEOUT", "3"))
+AIVIS_TIMEOUT = float(os.getenv("AIVIS_TIMEOUT", "60"))
+# エンジン1台あたりの同時接続数の上限
+AIVIS_MAX_CONNECTIONS = int(os.getenv("AIVIS_MAX_CONNECTIONS", "8"))
+# 複数エンジンに振り分ける場合の接続先（"host:port" のカンマ区切り。"host:port@4" で同時実行数を指定）
+AIVIS_ENGINES = os.getenv("AIVIS_ENGINES", "").strip()
+# エンジン1台あたりの同時合成数（合成はエンジン側で CPU を使い切るため小さめにする）
+AIVIS_ENGINE_CONCURRENCY = int(os.getenv("AIVIS_ENGINE_CONCURRENCY", "2"))
+# /version による死活監視の間隔（秒）
+AIVIS_HEALTH_INTERVAL = float(os.getenv("AIVIS_HEALTH_INTERVAL", "5"))
+# エラーやタイムアウト時に別のエンジンでやり直す回数
+AIVIS_RETRIES = int(os.getenv("AIVIS_RETRIES", "1"))
+
+
+class AivisSpeechClient:
+    """AivisSpeech Engine の非同期 HTTP クライアント
+
+    keep-alive の ClientSession をプロセス（イベントループ）の間使い回す。
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 10101,
+        timeout: float = AIVIS_TIMEOUT,
+        connect_timeout: float = AIVIS_CONNECT_TIMEOUT,
+        max_connections: int = AIVIS_MAX_CONNECTIONS,
+    ):
+        self.base_url = f"http://{host}:{port}"
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._max_connections = max_connections
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # /multi_synthesis に対応しているか（未確認なら None）
+        self.multi_synthesis_supported: Optional[bool] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_event_loop()
+        # セッションはイベントループに紐づくため、ループが変わったら作り直す
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self._max_connections, keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self._timeout
+            )
+            self._loop = loop
+        return self._session
+
+    async def audio_query(self, text: str, speaker: int) -> dict:
+        """/audio_query を呼び出して合成用クエリを取得する"""
+        session = self._get_session()
+        async with session.post(
+            f"{self.base_url}/audio_query",
+            params={"text": text, "speaker": speaker},
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def initialize_speaker(self, speaker: int, skip_reinit: bool = True) -> None:
+        """/initialize_speaker で話者のモデルを読み込ませる（読み込み済みなら何もしない）"""
+        session = self._get_session()
+        async with session.post(
+            f"{self.base_url}/initialize_speaker",
+            params={"speaker": speaker, "skip_reinit": "true" if skip_reinit else "false"},
+        ) as response:
+            response.raise_for_status()
+
+    async def synthesis(self, query: dict, speaker: int) -> bytes:
+        """/synthesis を呼び出して WAV データを取得する"""
+        session = self._get_session()
+        async with session.post(
+            f"{self.base_url}/synthesis",
+            params={"speaker": speaker},
+            json=query,
+        ) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def multi_synthesis(self, queries: List[dict], speaker: int) -> List[bytes]:
+        """/multi_synthesis で複数のクエリをまとめて合成し、WAV データを順に返す
+
+        エンジンが対応していない場合は NotImplementedError を送出する（結果は覚えておく）。
+        """
+        if self.multi_synthesis_supported is False:
+            raise NotImplementedError("/multi_synthesis is not supported")
+        session = self._get_session()
+        async with session.post(
+            f"{self.base_url}/multi_synthesis",
+            params={"speaker": speaker},
+            json=queries,
+        ) as response:
+            if response.status in (404, 405, 501):
+                self.multi_synthesis_supported = False
+                raise NotImplementedError("/multi_synthesis is not supported")
+            response.raise_for_status()
+            data = await response.read()
+        self.multi_synthesis_supported = True
+        # 応答は 001.wav, 002.wav, ... を含む zip
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = sorted(archive.namelist())
+            return [archive.read(name) for name in names]
+
+    async def version(self, timeout: float = AIVIS_CONNECT_TIMEOUT) -> str:
+        """/version を呼び出す（死活監視用）"""
+        session = self._get_session()
+        async with session.get(
+            f"{self.base_url}/version", timeout=aiohttp.ClientTimeout(total=timeout)
+        ) as response:
+            response.raise_for_status()
+            return await response.text()
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+def _is_retryable(error: BaseException) -> bool:
+    """別のエンジンでやり直す価値のあるエラーか（接続失敗・タイムアウト・5xx）"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class _Engine:
+    """プール内の1台のエンジンの状態"""
+
+    def __init__(self, client: AivisSpeechClient, concurrency: int):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.outstanding = 0
+        self.healthy = True
+        self.last_error: Optional[str] = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def load(self) -> float:
+        return self.outstanding / self.concurrency
+
+
+class AivisEnginePool:
+    """複数の AivisSpeech Engine に合成を振り分けるクライアント
+
+    AivisSpeechClient と同じメソッドを持ち、そのまま置き換えられる。
+    処理中（待ち含む）のリクエストが最も少ないエンジンを選び、エンジンごとの
+    同時実行数を超えた分はそのエンジンで順番待ちになる。
+    接続エラー・タイムアウト・5xx のときは別のエンジンでやり直し、失敗したエンジンは
+    /version の監視で復帰するまで振り分けから外す。
+    """
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, int, int]],
+        retries: int = AIVIS_RETRIES,
+        health_interval: float = AIVIS_HEALTH_INTERVAL,
+    ):
+        if not endpoints:
+            raise ValueError("エンジンが1つも指定されていません")
+        self.engines = [
+            _Engine(AivisSpeechClient(host, port), concurrency)
+            for host, port, concurrency in endpoints
+        ]
+        self.retries = retries
+        self.health_interval = health_interval
+        self._monitor: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _start(self) -> None:
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # セマフォと監視タスクはイベントループごとに作り直す
+            for engine in self.engines:
+                engine.slots = asyncio.Semaphore(engine.concurrency)
+                engine.outstanding = 0
+            self._monitor = None
+            self._loop = loop
+        if self._monitor is None and self.health_interval > 0:
+            self._monitor = asyncio.ensure_future(self._monitor_health())
+
+    def _choose(self, exclude) -> _Engine:
+        candidates = [e for e in self.engines if e.healthy and e not in exclude]
+        if not candidates:
+            # 正常なエンジンがなければ、まだ試していないものを順に試す
+            candidates = [e for e in self.engines if e not in exclude] or self.engines
+        return min(candidates, key=lambda e: e.load)
+
+    async def _call(self, method: str, *args):
+        self._start()
+        tried = []
+        while True:
+            engine = self._choose(tried)
+            tried.append(engine)
+            engine.outstanding += 1
+            engine.requests += 1
+            try:
+                async with engine.slots:
+                    result = await getattr(engine.client, method)(*args)
+                engine.healthy = True
+                return result
+            except Exception as e:
+                engine.failures += 1
+                if not _is_retryable(e):
+                    raise
+                engine.healthy = False
+                engine.last_error = f"{type(e).__name__}: {e}"
+                if len(tried) > self.retries:
+                    raise
+                print(f"AivisSpeech engine {engine.client.base_url} failed ({e}), retrying on another engine")
+            finally:
+                engine.outstanding -= 1
+
+    async def audio_query(self, text: str, speaker: int) -> dict:
+        return await self._call("audio_query", text, speaker)
+
+    async def synthesis(self, query: dict, speaker: int) -> bytes:
+        return await self._call("synthesis", query, speaker)
+
+    async def check_health(self) -> None:
+        """全エンジンの /version を並行して確認する"""
+
+        async def probe(engine: _Engine):
+            try:
+                await engine.client.version()
+            except Exception as e:
+                engine.healthy = False
+                engine.last_error = f"{type(e).__name__}: {e}"
+            else:
+                engine.healthy = True
+
+        await asyncio.gather(*(probe(engine) for engine in self.engines))
+
+    async def _monitor_health(self) -> None:
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self) -> List[dict]:
+        return [
+            {
+                "url": engine.client.base_url,
+                "healthy": engine.healthy,
+                "outstanding": engine.outstanding,
+                "concurrency": engine.concurrency,
+                "requests": engine.requests,
+                "failures": engine.failures,
+                "last_error": engine.last_error,
+            }
+            for engine in self.engines
+        ]
+
+    async def close(self) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        for engine in self.engines:
+            await engine.client.close()
+
+
+def parse_engines(spec: str, concurrency: int = AIVIS_ENGINE_CONCURRENCY) -> List[Tuple[str, int, int]]:
+    """"host:port[@同時実行数]" のカンマ区切りを解釈する"""
+    endpoints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        address, _, limit = item.partition("@")
+        host, _, port = address.rpartition(":")
+        endpoints.append((host or "127.0.0.1", int(port), int(limit) if limit else concurrency))
+    return endpoints
+
+
+_clients: Dict[Tuple[str, int], AivisSpeechClient] = {}
+_pool: Optional[AivisEnginePool] = None
+
+
+def get_client(host: str = "127.0.0.1", port: int = 10101):
+    """host:port ごとに共有クライアントを返す
+
+    AIVIS_ENGINES が設定されている場合は host/port によらず共有のエンジンプールを返す。
+    """
+    global _pool
+    if AIVIS_ENGINES:
+        if _pool is None:
+            _pool = AivisEnginePool(parse_engines(AIVIS_ENGINES))
+        return _pool
+    key = (host, port)
+    client = _clients.get(key)
+    if client is None:
+        client = AivisSpeechClient(host, port)
+        _clients[key] = client
+    return client
+
+
+async def close_clients() -> None:
+    """共有クライアントのセッションをすべて閉じる（終了時に呼ぶ）"""
+    for client in list(_clients.values()):
+        await client.close()
+    if _pool is not None:
+        await _pool.close()
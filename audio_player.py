@@ -0,0 +1,294 @@
+import os
+import time
+import atexit
+import wave
+import queue
+import threading
+from typing import Dict, Optional
+
+import numpy as np
+
+from audio_trim import crossfade, crossfade_samples
+from wav_format import DEFAULT_SAMPLE_RATE
+
+# 1回の書き込みで送るサンプル数（キャンセルはこの単位で反映される）
+AUDIO_BLOCK_SIZE = int(os.getenv("AUDIO_BLOCK_SIZE", "1024"))
+# PortAudio のバッファサイズ
+AUDIO_BUFFER_SIZE = int(os.getenv("AUDIO_BUFFER_SIZE", "1024"))
+# 出力先: "pyaudio"（デフォルト）, "file:<path>", "null"
+AUDIO_OUTPUT = os.getenv("AUDIO_OUTPUT", "pyaudio").strip()
+
+
+class PyAudioOutput:
+    """PyAudio のストリームに書き込む出力先"""
+
+    def __init__(self, frames_per_buffer: int = AUDIO_BUFFER_SIZE):
+        self.frames_per_buffer = frames_per_buffer
+        self._pya = None
+        self._stream = None
+
+    def open(self, sample_rate: int) -> None:
+        import pyaudio
+
+        if self._pya is None:
+            self._pya = pyaudio.PyAudio()
+        self._stream = self._pya.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=sample_rate,
+            output=True,
+            frames_per_buffer=self.frames_per_buffer,
+        )
+        # 最小限の無音データを書き込んでバッファを準備（ストリームを開いたときだけ）
+        silence = np.zeros(self.frames_per_buffer, dtype=np.int16)
+        self._stream.write(silence.tobytes())
+
+    def write(self, data: bytes) -> None:
+        self._stream.write(data)
+
+    def close(self, final: bool = False) -> None:
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+        if self._pya is not None:
+            self._pya.terminate()
+            self._pya = None
+
+
+class FileOutput:
+    """WAV ファイルに書き出す出力先（音声デバイス不要）
+
+    path が None の場合は書き込みを捨てる。realtime=True なら実時間で進める。
+    ファイルは最初に開いたときだけ作り、プレイヤーが開き直しても同じファイルに書き続ける
+    （サンプルレートは最初の発話のものに固定し、異なる発話は変換して書く）。
+    """
+
+    def __init__(self, path: Optional[str] = None, realtime: bool = False):
+        self.path = path
+        self.realtime = realtime
+        self._wav = None
+        self._sample_rate = 0
+        self._file_rate = 0
+
+    def open(self, sample_rate: int) -> None:
+        self._sample_rate = sample_rate
+        if self.path and self._wav is None:
+            self._wav = wave.open(self.path, "wb")
+            self._wav.setnchannels(1)
+            self._wav.setsampwidth(2)
+            self._wav.setframerate(sample_rate)
+            self._file_rate = sample_rate
+
+    def write(self, data: bytes) -> None:
+        if self.realtime:
+            time.sleep(len(data) / 2 / self._sample_rate)
+        if self._wav is not None:
+            if self._sample_rate != self._file_rate:
+                data = _resample(np.frombuffer(data, dtype=np.int16), self._sample_rate, self._file_rate).tobytes()
+            self._wav.writeframes(data)
+
+    def close(self, final: bool = False) -> None:
+        # ヘッダは書き込みごとに更新されるので、開き直しのときはファイルを閉じない
+        if final and self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+def _resample(audio: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    """線形補間でサンプルレートを変換する"""
+    count = int(round(len(audio) * to_rate / from_rate))
+    positions = np.arange(count) * (from_rate / to_rate)
+    return np.interp(positions, np.arange(len(audio)), audio).astype(np.int16)
+
+
+def create_output(spec: str = AUDIO_OUTPUT):
+    """AUDIO_OUTPUT の指定から出力先を作る"""
+    if spec.startswith("file:"):
+        return FileOutput(spec[len("file:"):])
+    if spec == "null":
+        return FileOutput(None)
+    return PyAudioOutput()
+
+
+class AudioPlayer:
+    """1本のスレッドと1本の出力ストリームで発話を順番に再生するプレイヤー
+
+    enqueue() された発話はキューに積まれ、途切れなく連続して再生される。
+    次の発話がすでに待っている場合は、末尾の crossfade_ms を次の発話の先頭と重ねる。
+    同じ group で追加したもの（1文を分割したチャンク）の間は重ねない。
+    owner を付けて追加した発話は cancel(owner) でその owner の分だけ取り消せる。
+    """
+
+    def __init__(self, output=None, block_size: int = AUDIO_BLOCK_SIZE, crossfade_ms: Optional[float] = None):
+        self.output = output if output is not None else create_output()
+        self.block_size = block_size
+        self.crossfade_ms = crossfade_ms
+        self._queue: "queue.Queue" = queue.Queue()
+        self._generation = 0
+        self._pending = 0
+        # 追加した発話の通し番号と、owner ごとの再生待ちの数・取り消した時点の通し番号
+        self._seq = 0
+        self._owner_pending: Dict[object, int] = {}
+        self._owner_cancelled: Dict[object, int] = {}
+        self._lock = threading.Lock()
+        self._sample_rate = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def enqueue(self, audio_data, progress, sample_rate: int = DEFAULT_SAMPLE_RATE, group=None, owner=None) -> None:
+        """発話を再生キューに追加する（group を省略した場合は1件ごとに別の発話として扱う）"""
+        with self._lock:
+            self._seq += 1
+            ticket = (self._generation, owner, self._seq)
+            self._pending += 1
+            if owner is not None:
+                self._owner_pending[owner] = self._owner_pending.get(owner, 0) + 1
+        self._queue.put((audio_data, progress, sample_rate, ticket, group if group is not None else progress))
+
+    def pending(self) -> int:
+        """再生中または再生待ちの発話の数"""
+        with self._lock:
+            return self._pending
+
+    def cancel(self, owner=None) -> None:
+        """再生中と再生待ちの発話を取り消す（1ブロック以内に止まる）
+
+        owner を指定した場合は、その owner で追加した発話だけを取り消す。
+        """
+        with self._lock:
+            if owner is None:
+                self._generation += 1
+            elif owner in self._owner_pending:
+                self._owner_cancelled[owner] = self._seq
+
+    def close(self, cancel: bool = True) -> None:
+        """プレイヤーを停止する（cancel=False なら再生待ちを鳴らし切ってから止める）"""
+        if cancel:
+            self.cancel()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _is_cancelled(self, ticket) -> bool:
+        generation, owner, seq = ticket
+        with self._lock:
+            if generation != self._generation:
+                return True
+            return owner is not None and seq <= self._owner_cancelled.get(owner, 0)
+
+    def _release(self, ticket) -> None:
+        """再生し終えた（または取り消した）発話の分を数から外す"""
+        _, owner, _ = ticket
+        with self._lock:
+            self._pending -= 1
+            if owner is not None:
+                remaining = self._owner_pending[owner] - 1
+                if remaining:
+                    self._owner_pending[owner] = remaining
+                else:
+                    del self._owner_pending[owner]
+                    self._owner_cancelled.pop(owner, None)
+
+    def _run(self) -> None:
+        # 前の発話の末尾で、次の発話と重ねるために書き込んでいない分 (PCM, サンプルレート, チケット)
+        carry = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    if carry is not None and not self._is_cancelled(carry[2]):
+                        try:
+                            self.output.write(carry[0].tobytes())
+                        except Exception as e:
+                            print(f"Audio playback error: {e}")
+                    return
+                audio_data, progress, sample_rate, ticket, group = item
+                try:
+                    if carry is not None and self._is_cancelled(carry[2]):
+                        carry = None
+                    if not self._is_cancelled(ticket):
+                        carry = self._play(audio_data, progress, sample_rate, ticket, carry, group)
+                except Exception as e:
+                    # デバイスの変更などで書き込めなくても、スレッドは止めずに次の発話で開き直す
+                    print(f"Audio playback error: {e}")
+                    carry = None
+                    self._reset_output()
+                finally:
+                    self._release(ticket)
+                    progress.finish()
+        finally:
+            self.output.close(final=True)
+
+    def _reset_output(self) -> None:
+        """出力を閉じ、次の発話で開き直させる"""
+        try:
+            self.output.close()
+        except Exception as e:
+            print(f"Audio output close error: {e}")
+        self._sample_rate = 0
+
+    def _next_is_other_utterance(self, group) -> bool:
+        """キューの先頭に別の発話が待っているか"""
+        with self._queue.mutex:
+            if not self._queue.queue:
+                return False
+            item = self._queue.queue[0]
+        return item is not None and item[4] is not group
+
+    def _play(self, audio_data, progress, sample_rate, ticket, carry=None, group=None):
+        """発話を書き込み、次の発話と重ねるために残した末尾を返す（残さなければ None）"""
+        head = None
+        if carry is not None:
+            tail, carry_rate, _ = carry
+            if carry_rate == sample_rate and len(audio_data) >= len(tail):
+                head = crossfade(tail, audio_data[:len(tail)])
+            else:
+                self.output.write(tail.tobytes())
+
+        if sample_rate != self._sample_rate:
+            # サンプルレートが変わったときだけストリームを開き直す
+            if self._sample_rate:
+                self.output.close()
+            self.output.open(sample_rate)
+            self._sample_rate = sample_rate
+
+        start = 0
+        if head is not None:
+            # 前の発話の末尾と重ねた先頭部分
+            self.output.write(head.tobytes())
+            start = len(head)
+            progress.update(start)
+
+        # 次の発話が待っていれば、末尾を書き込まずに残して重ねる（同じ文のチャンクの間は重ねない）
+        end = len(audio_data)
+        overlap = crossfade_samples(sample_rate, self.crossfade_ms)
+        if overlap and end - start > overlap * 2 and self._next_is_other_utterance(group):
+            end -= overlap
+
+        # ブロック単位で音声データを書き込む
+        block_size = self.block_size
+        for i in range(start, end, block_size):
+            if self._is_cancelled(ticket):
+                return None
+            self.output.write(audio_data[i:min(i + block_size, end)].tobytes())
+            progress.update(min(i + block_size, end))
+
+        if end == len(audio_data):
+            return None
+        progress.update(len(audio_data))
+        return audio_data[end:], sample_rate, ticket
+
+
+_player: Optional[AudioPlayer] = None
+_player_lock = threading.Lock()
+
+
+def get_player() -> AudioPlayer:
+    """プロセス共有のプレイヤーを返す（初回呼び出し時に起動）"""
+    global _player
+    with _player_lock:
+        if _player is None:
+            _player = AudioPlayer()
+            # プロセス終了時は再生待ちの音声を最後まで鳴らしてから止める
+            atexit.register(_player.close, cancel=False)
+        return _player
@@ -0,0 +1,118 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+# 合成した音声の前後の無音を削る（0で無効）
+TRIM_SILENCE = os.getenv("TRIM_SILENCE", "1").strip() != "0"
+# 無音とみなす音量（dBFS、フレームごとの RMS で判定）
+TRIM_THRESHOLD_DB = float(os.getenv("TRIM_THRESHOLD_DB", "-45"))
+# 音量を判定するフレームの長さ（ミリ秒）
+TRIM_FRAME_MS = float(os.getenv("TRIM_FRAME_MS", "5"))
+# 削ったあとに前後に残す余白（ミリ秒、子音の立ち上がりを削りすぎないため）
+TRIM_KEEP_MS = float(os.getenv("TRIM_KEEP_MS", "20"))
+# 前後の端にかけるフェードの長さ（ミリ秒、削った端のクリックノイズを防ぐ）
+TRIM_FADE_MS = float(os.getenv("TRIM_FADE_MS", "5"))
+# /audio_query の prePhonemeLength / postPhonemeLength を上書きする秒数（空ならエンジンの既定値）
+PRE_PHONEME_LENGTH = os.getenv("PRE_PHONEME_LENGTH", "0.05").strip()
+POST_PHONEME_LENGTH = os.getenv("POST_PHONEME_LENGTH", "0.05").strip()
+# 続けて再生する発話の間のクロスフェードの長さ（ミリ秒、0で無効）
+SPEECH_CROSSFADE_MS = float(os.getenv("SPEECH_CROSSFADE_MS", "10"))
+
+
+def query_overrides() -> dict:
+    """/audio_query の結果に上書きする前後の無音の長さ"""
+    overrides = {}
+    if PRE_PHONEME_LENGTH:
+        overrides["prePhonemeLength"] = float(PRE_PHONEME_LENGTH)
+    if POST_PHONEME_LENGTH:
+        overrides["postPhonemeLength"] = float(POST_PHONEME_LENGTH)
+    return overrides
+
+
+def cache_params() -> dict:
+    """合成結果を変える加工の設定（設定を変えたら別のキャッシュになるようキーに含める）"""
+    params = query_overrides()
+    if TRIM_SILENCE:
+        params["trim"] = [TRIM_THRESHOLD_DB, TRIM_FRAME_MS, TRIM_KEEP_MS, TRIM_FADE_MS]
+    return params
+
+
+def _samples(ms: float, sample_rate: int) -> int:
+    return int(sample_rate * ms / 1000)
+
+
+def find_voiced(
+    audio: np.ndarray,
+    sample_rate: int = 44100,
+    threshold_db: float = TRIM_THRESHOLD_DB,
+    frame_ms: float = TRIM_FRAME_MS,
+) -> Tuple[int, int]:
+    """閾値を超える区間の (開始, 終了) サンプル位置を返す（全体が無音なら全体）
+
+    フレームに分けた配列の二乗平均を一度に計算するので、Python のループは回らない。
+    """
+    frame = max(1, _samples(frame_ms, sample_rate))
+    n_frames = len(audio) // frame
+    if n_frames == 0:
+        return 0, len(audio)
+    frames = audio[:n_frames * frame].reshape(n_frames, frame).astype(np.float32)
+    energy = np.einsum("ij,ij->i", frames, frames) / frame
+    threshold = (32768.0 * 10 ** (threshold_db / 20)) ** 2
+    voiced = np.flatnonzero(energy > threshold)
+    if len(voiced) == 0:
+        return 0, len(audio)
+    start = int(voiced[0]) * frame
+    # 最後のフレームまで有音なら、フレームに満たない端数も残す
+    end = len(audio) if voiced[-1] == n_frames - 1 else (int(voiced[-1]) + 1) * frame
+    return start, end
+
+
+def apply_fades(audio: np.ndarray, fade_in: int, fade_out: int) -> np.ndarray:
+    """先頭にフェードイン、末尾にフェードアウトをかける（audio は書き換え可能な配列）"""
+    fade_in = min(fade_in, len(audio))
+    fade_out = min(fade_out, len(audio))
+    if fade_in:
+        audio[:fade_in] = audio[:fade_in] * np.linspace(0.0, 1.0, fade_in, dtype=np.float32)
+    if fade_out:
+        audio[-fade_out:] = audio[-fade_out:] * np.linspace(1.0, 0.0, fade_out, dtype=np.float32)
+    return audio
+
+
+def trim(
+    audio: np.ndarray,
+    sample_rate: int = 44100,
+    head: bool = True,
+    tail: bool = True,
+) -> Tuple[np.ndarray, int]:
+    """前後の無音を削ってフェードをかけ、(音声, 先頭から削ったサンプル数) を返す
+
+    head / tail が False の端は削らない（分割合成の途中のチャンクの境目など）。
+    TRIM_SILENCE=0 のときは削らずにフェードだけをかける。
+    """
+    start, end = 0, len(audio)
+    if TRIM_SILENCE and (head or tail):
+        voiced_start, voiced_end = find_voiced(audio, sample_rate)
+        keep = _samples(TRIM_KEEP_MS, sample_rate)
+        if head:
+            start = max(0, voiced_start - keep)
+        if tail:
+            end = min(len(audio), voiced_end + keep)
+    fade = _samples(TRIM_FADE_MS, sample_rate)
+    audio = apply_fades(
+        audio[start:end].copy(), fade if head else 0, fade if tail else 0
+    )
+    return audio, start
+
+
+def crossfade_samples(sample_rate: int = 44100, ms: Optional[float] = None) -> int:
+    """発話の間のクロスフェードのサンプル数"""
+    return _samples(SPEECH_CROSSFADE_MS if ms is None else ms, sample_rate)
+
+
+def crossfade(tail: np.ndarray, head: np.ndarray) -> np.ndarray:
+    """前の発話の末尾 tail と次の発話の先頭 head を重ねた配列を返す（長さは短い方）"""
+    n = min(len(tail), len(head))
+    ramp = np.linspace(0.0, 1.0, n, dtype=np.float32)
+    mixed = tail[-n:] * (1.0 - ramp) + head[:n] * ramp
+    return np.clip(mixed, -32768, 32767).astype(np.int16)
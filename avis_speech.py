@@ -179,8 +179,7 @@ def notify_mac(
 
 async def wait_until_finished(progress) -> None:
     """進捗が終了するまで待つ（文字表示なし）"""
-    while not progress.is_finished:
-        await asyncio.sleep(0.05)
+    await progress.wait_finished()
 
 
 def build_arg_parser() -> argparse.ArgumentParser:
@@ -225,16 +224,99 @@ def build_arg_parser() -> argparse.ArgumentParser:
     p.add_argument("--name", dest="name", help="通知に表示する名前")
     # 同期実行
     p.add_argument("--sync", dest="sync_mode", action="store_true", help="同期実行（音声再生完了まで待機）")
+    # 標準入力を1行ずつ読み上げる
+    p.add_argument("--stream", dest="stream", action="store_true", help="標準入力を1行ずつ読み上げる（tail -f などと組み合わせる）")
+    p.add_argument(
+        "--policy",
+        dest="policy",
+        choices=["merge", "drop-oldest", "summarize"],
+        help="--stream で読み上げが追いつかないときの扱い（default: 環境変数 STREAM_POLICY または merge）",
+    )
+    p.add_argument("--max-pending", dest="max_pending", type=int, help="--stream で読み上げ待ちにしておく行の上限")
+    # 常駐デーモンを使わない
+    p.add_argument("--no-daemon", dest="no_daemon", action="store_true", help="常駐デーモンを使わず、このプロセスで合成・再生する")
     # alerter を優先して使う（左アイコン差し替えとの相性が良い場合あり）
     p.add_argument("--prefer-alerter", dest="prefer_alerter", action="store_true", help="alerter バックエンドを優先的に使用する")
     p.add_argument("--alerter", dest="alerter_path", help="alerter のパス（例: /opt/homebrew/bin/alerter）")
     return p
 
 
+def _notify(args, text: str) -> None:
+    """通知表示（macOS でのみ有効）。失敗時は静かにスキップ。"""
+    if not args.no_notify:
+        # 右側（contentImage）
+        icon_path = None
+        # --right-icon 優先、なければ --icon
+        right_candidate = getattr(args, "right_icon", None) or getattr(args, "icon", None)
+        if right_candidate and getattr(args, "show_right_icon", False):
+            icon_path = right_candidate
+        elif getattr(args, "show_right_icon", False):
+            default_icon = os.path.join(os.path.dirname(__file__), "static", "images", "maid_icon.png")
+            if os.path.exists(default_icon):
+                icon_path = default_icon
+        # 左側（appIcon）
+        left_icon = getattr(args, "left_icon", None)
+        notify_mac(
+            text,
+            title="AVIS",
+            icon_path=icon_path,
+            left_icon_path=left_icon,
+            sender=getattr(args, "sender", None),
+            debug=getattr(args, "debug_notify", False),
+            tn_path=getattr(args, "tn_path", None),
+            prefer_alerter=getattr(args, "prefer_alerter", False),
+            alerter_path=getattr(args, "alerter_path", None),
+            name=getattr(args, "name", None),
+            show_right_icon=getattr(args, "show_right_icon", False),
+        )
+        # アイコン表示のヒント
+        if (icon_path or left_icon) and sys.platform == "darwin" and not shutil.which("terminal-notifier"):
+            print("ヒント: アイコン付き通知には 'brew install terminal-notifier' を実行してください。")
+
+
+async def stream_main(args) -> int:
+    """標準入力を1行ずつ読み上げる（入力が終わるまで常駐する）"""
+    try:
+        line_stream = import_module("line_stream")
+        speech_mod = import_module("speech")
+    except Exception as ie:
+        print("依存モジュールの読み込みに失敗しました。'pip install -r requirements.txt' を実行してください。")
+        print(f"詳細: {ie}")
+        return 1
+
+    buffer = line_stream.LineBuffer(
+        policy=args.policy or line_stream.STREAM_POLICY,
+        max_pending=args.max_pending or line_stream.STREAM_MAX_PENDING,
+    )
+    loop = asyncio.get_event_loop()
+
+    async def display(line, progress):
+        print(line, flush=True)
+        # 通知コマンドの実行で読み上げを止めないよう別スレッドで行う
+        await loop.run_in_executor(None, _notify, args, line)
+        await progress.wait_finished()
+
+    try:
+        await line_stream.speak_lines(
+            buffer, display, host=args.host, port=args.port, speaker=args.speaker
+        )
+    finally:
+        await speech_mod.close_clients()
+        if getattr(args, "debug_notify", False):
+            print(f"stream stats: {buffer.stats()}")
+    return 0
+
+
 async def main(argv: Optional[List[str]] = None) -> int:
     parser = build_arg_parser()
     args = parser.parse_args(argv)
 
+    if args.stream:
+        try:
+            return await stream_main(args)
+        except KeyboardInterrupt:
+            return 130
+
     # 入力テキストの決定（引数優先、なければ標準入力）
     if args.text:
         text = " ".join(args.text).strip()
@@ -250,17 +332,35 @@ async def main(argv: Optional[List[str]] = None) -> int:
         return 2
 
     try:
+        progress = None
+        if not args.no_daemon:
+            # 常駐デーモンに依頼する（重い依存はデーモン側でだけ読み込む）
+            try:
+                from speech_daemon import DaemonUnavailable, request_speech
+                request_speech(
+                    text,
+                    host=args.host,
+                    port=args.port,
+                    speaker=args.speaker,
+                    wait=args.sync_mode,
+                    on_started=None if args.no_notify else (lambda: _notify(args, text)),
+                )
+                return 0
+            except DaemonUnavailable as e:
+                print(f"デーモンを利用できないため、このプロセスで再生します: {e}")
+
         # 遅延インポート（ヘルプ表示などで依存を避ける）
         try:
             speech_mod = import_module("speech")
-            speech_fn = getattr(speech_mod, "speech")
+            # 複数の文からなるテキストは文ごとにまとめて合成する
+            speech_fn = getattr(speech_mod, "speech_batch")
         except Exception as ie:
             print("依存モジュールの読み込みに失敗しました。'pip install -r requirements.txt' を実行してください。")
             print(f"詳細: {ie}")
             return 1
 
-        # デフォルトは非同期モード（--syncが指定されていない場合）
-        if not getattr(args, "sync_mode", False):
+        # --no-daemon でも --sync がなければ別プロセスで実行してすぐに戻る
+        if not getattr(args, "sync_mode", False) and args.no_daemon:
             # 現在の引数に--syncを追加して別プロセスで実行
             new_args = sys.argv[1:] + ["--sync"]
             
@@ -269,38 +369,13 @@ async def main(argv: Optional[List[str]] = None) -> int:
             return 0
         else:
             # 同期モードは音声再生を開始してから通知
-            progress = await speech_fn(text, host=args.host, port=args.port, speaker=args.speaker)
+            try:
+                progress = await speech_fn(text, host=args.host, port=args.port, speaker=args.speaker)
+            finally:
+                # keep-alive セッションを閉じる（再生は別スレッドで継続）
+                await speech_mod.close_clients()
             
-        # 通知表示（macOS でのみ有効）。失敗時は静かにスキップ。
-        if not args.no_notify:
-            # 右側（contentImage）
-            icon_path = None
-            # --right-icon 優先、なければ --icon
-            right_candidate = getattr(args, "right_icon", None) or getattr(args, "icon", None)
-            if right_candidate and getattr(args, "show_right_icon", False):
-                icon_path = right_candidate
-            elif getattr(args, "show_right_icon", False):
-                default_icon = os.path.join(os.path.dirname(__file__), "static", "images", "maid_icon.png")
-                if os.path.exists(default_icon):
-                    icon_path = default_icon
-            # 左側（appIcon）
-            left_icon = getattr(args, "left_icon", None)
-            notify_mac(
-                text,
-                title="AVIS",
-                icon_path=icon_path,
-                left_icon_path=left_icon,
-                sender=getattr(args, "sender", None),
-                debug=getattr(args, "debug_notify", False),
-                tn_path=getattr(args, "tn_path", None),
-                prefer_alerter=getattr(args, "prefer_alerter", False),
-                alerter_path=getattr(args, "alerter_path", None),
-                name=getattr(args, "name", None),
-                show_right_icon=getattr(args, "show_right_icon", False),
-            )
-            # アイコン表示のヒント
-            if (icon_path or left_icon) and sys.platform == "darwin" and not shutil.which("terminal-notifier"):
-                print("ヒント: アイコン付き通知には 'brew install terminal-notifier' を実行してください。")
+        _notify(args, text)
 
         # 同期モードの場合は再生完了まで待機
         if getattr(args, "sync_mode", False) and progress:
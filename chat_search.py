@@ -0,0 +1,176 @@
+from typing import List, Tuple
+
+from database import database
+
+# 検索結果の1ページあたりの件数
+SEARCH_PAGE_SIZE = 20
+# スニペットの長さ（トークン数。trigram では1トークンがおよそ1文字）
+SNIPPET_TOKENS = 24
+
+# スニペット中の一致箇所を示す印（本文に現れない制御文字）
+_MATCH_START = "\x02"
+_MATCH_END = "\x03"
+
+# trigram トークナイザは3文字未満の語を MATCH で検索できない
+_MIN_MATCH_LENGTH = 3
+
+_SCHEMA = [
+    # 本文は chat_messages に置いたまま索引だけを持つ（external content）
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        content, content='chat_messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF content ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content)
+        VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# 全文検索索引が使えるか（SQLite 3.34 以降の FTS5 が必要）
+search_available = False
+
+
+async def migrate_search() -> None:
+    """全文検索の索引とトリガーを作成する（起動時に呼ぶ）
+
+    初めて作成したときは既存のメッセージから索引を構築する。
+    """
+    global search_available
+    if database.url.dialect != "sqlite":
+        return
+    exists = await database.fetch_val(
+        "SELECT count(*) FROM sqlite_master WHERE name = 'chat_messages_fts'"
+    )
+    try:
+        async with database.transaction():
+            for statement in _SCHEMA:
+                await database.execute(statement)
+            if not exists:
+                await database.execute(
+                    "INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')"
+                )
+    except Exception as e:
+        print(f"Full-text search is disabled (FTS5 trigram is not available): {e}")
+        return
+    search_available = True
+
+
+def _phrase(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _like(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _segments(snippet: str) -> List[dict]:
+    """印つきのスニペットを [{"text": ..., "match": bool}] に分ける"""
+    segments = []
+    for i, part in enumerate(snippet.split(_MATCH_START)):
+        if i == 0:
+            text, rest = "", part
+        else:
+            text, _, rest = part.partition(_MATCH_END)
+        if text:
+            segments.append({"text": text, "match": True})
+        if rest:
+            segments.append({"text": rest, "match": False})
+    return segments
+
+
+def _short_snippet(content: str, terms: List[str]) -> List[dict]:
+    """MATCH を使わない検索のスニペット（最初の一致の前後を切り出す）"""
+    positions = [(content.find(term), term) for term in terms if term in content]
+    if not positions:
+        return [{"text": content[:SNIPPET_TOKENS * 2], "match": False}]
+    start, term = min(positions)
+    begin = max(0, start - SNIPPET_TOKENS)
+    end = min(len(content), start + len(term) + SNIPPET_TOKENS)
+    segments = []
+    head = ("…" if begin > 0 else "") + content[begin:start]
+    if head:
+        segments.append({"text": head, "match": False})
+    segments.append({"text": term, "match": True})
+    tail = content[start + len(term):end] + ("…" if end < len(content) else "")
+    if tail:
+        segments.append({"text": tail, "match": False})
+    return segments
+
+
+async def search_messages(
+    query: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0
+) -> Tuple[List[dict], bool]:
+    """メッセージを全文検索し、(結果, 続きがあるか) を返す
+
+    空白区切りの語をすべて含むメッセージを関連度順（bm25）に返す。
+    3文字未満の語は索引で引けないため LIKE で絞り込む。
+    """
+    terms = query.split()
+    if not terms:
+        return [], False
+    long_terms = [t for t in terms if len(t) >= _MIN_MATCH_LENGTH]
+    short_terms = [t for t in terms if len(t) < _MIN_MATCH_LENGTH]
+
+    values = {"limit": limit + 1, "offset": offset}
+    conditions = []
+    for i, term in enumerate(short_terms):
+        conditions.append(f"m.content LIKE :like{i} ESCAPE '\\'")
+        values[f"like{i}"] = _like(term)
+
+    if long_terms:
+        values["match"] = " AND ".join(_phrase(t) for t in long_terms)
+        sql = f"""
+            SELECT m.id, m.chat_id, m.role, m.timestamp, c.title,
+                   snippet(chat_messages_fts, 0, '{_MATCH_START}', '{_MATCH_END}', '…', {SNIPPET_TOKENS}) AS snippet
+            FROM chat_messages_fts
+            JOIN chat_messages AS m ON m.id = chat_messages_fts.rowid
+            JOIN chats AS c ON c.id = m.chat_id
+            WHERE chat_messages_fts MATCH :match {"".join(" AND " + c for c in conditions)}
+            ORDER BY bm25(chat_messages_fts), m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        sql = f"""
+            SELECT m.id, m.chat_id, m.role, m.timestamp, c.title, m.content
+            FROM chat_messages AS m
+            JOIN chats AS c ON c.id = m.chat_id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY m.timestamp DESC, m.id DESC
+            LIMIT :limit OFFSET :offset
+        """
+
+    rows = await database.fetch_all(sql, values)
+    has_more = len(rows) > limit
+    results = []
+    for row in rows[:limit]:
+        if long_terms:
+            snippet = _segments(row["snippet"] or "")
+        else:
+            snippet = _short_snippet(row["content"] or "", short_terms)
+        results.append(
+            {
+                "message_id": row["id"],
+                "chat_id": row["chat_id"],
+                "chat_title": row["title"],
+                "role": row["role"],
+                "timestamp": row["timestamp"],
+                "snippet": snippet,
+            }
+        )
+    return results, has_more
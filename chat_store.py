@@ -0,0 +1,441 @@
+import os
+import time
+import asyncio
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, or_, select
+
+from database import database, Chat, ChatMessage
+
+# 1ページあたりの件数
+CHAT_LIST_PAGE_SIZE = int(os.getenv("CHAT_LIST_PAGE_SIZE", "50"))
+MESSAGE_PAGE_SIZE = int(os.getenv("MESSAGE_PAGE_SIZE", "100"))
+# サイドバーの会話一覧をキャッシュする秒数（他プロセスからの更新はこの間反映されない）
+CHAT_LIST_CACHE_TTL = float(os.getenv("CHAT_LIST_CACHE_TTL", "5"))
+# 接続ごとに保持する直近の履歴の件数（LLM に渡す分はトークン予算でさらに絞る）
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "40"))
+# 書き込みをキューに溜めてまとめてコミットする（1で有効）
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0").strip() == "1"
+# まとめる最大の待ち時間（秒）と件数
+DB_WRITE_BATCH_INTERVAL = float(os.getenv("DB_WRITE_BATCH_INTERVAL", "0.05"))
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "64"))
+
+# SQLite の接続ごとの設定（WAL ではコミットごとの fsync を省けるので synchronous=NORMAL）
+SQLITE_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "busy_timeout": "5000",
+    "temp_store": "MEMORY",
+    "cache_size": "-16000",
+}
+
+chats_table = Chat.__table__
+messages_table = ChatMessage.__table__
+
+# キーセットページングのカーソル（並び替えキーの値, id）
+Cursor = Tuple[datetime, int]
+Page = Tuple[List[dict], Optional[Cursor]]
+
+
+def parse_cursor(before: Optional[str], before_id: Optional[int]) -> Optional[Cursor]:
+    """クエリパラメータからカーソルを作る"""
+    if before is None or before_id is None:
+        return None
+    return datetime.fromisoformat(before), before_id
+
+
+def cursor_params(cursor: Optional[Cursor]) -> Optional[dict]:
+    """カーソルをクエリパラメータ用の dict にする"""
+    if cursor is None:
+        return None
+    return {"before": cursor[0].isoformat(), "before_id": cursor[1]}
+
+
+class ChatListCache:
+    """サイドバー用チャット一覧（先頭ページ）のキャッシュ
+
+    チャットの作成・更新・削除で invalidate() する。クエリ中に無効化された場合は
+    古い結果を保存しない。
+    """
+
+    def __init__(self, ttl: float = CHAT_LIST_CACHE_TTL):
+        self.ttl = ttl
+        self._value: Optional[Page] = None
+        self._expires = 0.0
+        self._version = 0
+
+    def get(self) -> Optional[Page]:
+        if self._value is not None and time.monotonic() < self._expires:
+            return self._value
+        return None
+
+    def set(self, value: Page, version: int) -> None:
+        if version == self._version:
+            self._value = value
+            self._expires = time.monotonic() + self.ttl
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self) -> None:
+        self._version += 1
+        self._value = None
+
+
+chat_list_cache = ChatListCache()
+
+
+async def list_chats(limit: int = CHAT_LIST_PAGE_SIZE, before: Optional[Cursor] = None) -> Page:
+    """更新日時の新しい順にチャットを返す（次ページのカーソル付き）"""
+    query = (
+        chats_table.select()
+        .order_by(chats_table.c.updated_at.desc(), chats_table.c.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        updated_at, chat_id = before
+        query = query.where(
+            or_(
+                chats_table.c.updated_at < updated_at,
+                and_(chats_table.c.updated_at == updated_at, chats_table.c.id < chat_id),
+            )
+        )
+    rows = [dict(row) for row in await database.fetch_all(query)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]["updated_at"], rows[-1]["id"])
+    return rows, next_cursor
+
+
+async def get_sidebar_chats() -> Page:
+    """サイドバー用の先頭ページ（キャッシュ済みならクエリしない）"""
+    cached = chat_list_cache.get()
+    if cached is not None:
+        return cached
+    version = chat_list_cache.version
+    page = await list_chats()
+    chat_list_cache.set(page, version)
+    return page
+
+
+async def get_chat(chat_id: int) -> Optional[dict]:
+    row = await database.fetch_one(chats_table.select().where(chats_table.c.id == chat_id))
+    return dict(row) if row else None
+
+
+async def get_message_chat_id(message_id: int) -> Optional[int]:
+    return await database.fetch_val(
+        select(messages_table.c.chat_id).where(messages_table.c.id == message_id)
+    )
+
+
+async def list_messages(
+    chat_id: int, limit: int = MESSAGE_PAGE_SIZE, before: Optional[Cursor] = None
+) -> Page:
+    """チャットのメッセージを古い順に返す
+
+    before より前の最新 limit 件を取り、さらに古いものがあればそのカーソルも返す。
+    """
+    query = (
+        messages_table.select()
+        .where(messages_table.c.chat_id == chat_id)
+        .order_by(messages_table.c.timestamp.desc(), messages_table.c.id.desc())
+        .limit(limit + 1)
+    )
+    if before is not None:
+        timestamp, message_id = before
+        query = query.where(
+            or_(
+                messages_table.c.timestamp < timestamp,
+                and_(messages_table.c.timestamp == timestamp, messages_table.c.id < message_id),
+            )
+        )
+    rows = [dict(row) for row in await database.fetch_all(query)]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]["timestamp"], rows[-1]["id"])
+    rows.reverse()
+    return rows, next_cursor
+
+
+async def recent_history(chat_id: int, limit: int = HISTORY_WINDOW) -> List[dict]:
+    """直近 limit 件の履歴を古い順に返す（LLM に渡す形式）"""
+    query = (
+        select(messages_table.c.role, messages_table.c.content)
+        .where(messages_table.c.chat_id == chat_id)
+        .order_by(messages_table.c.timestamp.desc(), messages_table.c.id.desc())
+        .limit(limit)
+    )
+    rows = await database.fetch_all(query)
+    return [{"role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+
+# 履歴が変わった回数（会話ごと）。同じ会話を開いている他の接続の変更を検出する
+_history_versions: Dict[int, int] = {}
+
+
+def invalidate_history(chat_id: int) -> int:
+    """履歴ウィンドウを次の参照時に読み直させる（新しい版数を返す）"""
+    version = _history_versions.get(chat_id, 0) + 1
+    _history_versions[chat_id] = version
+    return version
+
+
+class HistoryWindow:
+    """接続ごとに保持する直近の履歴
+
+    最初の参照時にだけデータベースから読み、以後は save() で保存したメッセージを
+    追加していく。他の接続で同じ会話が変更された場合は次の get() で読み直す。
+    版数はコミットされてから上げるので、他の接続がコミット前の内容を読んで
+    最新とみなすことはない。
+    """
+
+    def __init__(self, chat_id: int, size: int = HISTORY_WINDOW):
+        self.chat_id = chat_id
+        self.size = size
+        self._messages: deque = deque(maxlen=size)
+        self._version: Optional[int] = None
+
+    async def get(self) -> List[dict]:
+        version = _history_versions.get(self.chat_id, 0)
+        if self._version != version:
+            self._messages.clear()
+            self._messages.extend(await recent_history(self.chat_id, self.size))
+            self._version = version
+        return list(self._messages)
+
+    async def save(
+        self,
+        role: str,
+        content: str,
+        timestamp: Optional[datetime] = None,
+        touch_chat: bool = True,
+    ) -> None:
+        """メッセージを保存し、この接続の履歴にも加える"""
+        await self.get()
+        await save_message(
+            self.chat_id, role, content, timestamp, touch_chat, on_commit=self._committed
+        )
+        self._messages.append({"role": role, "content": content})
+
+    def _committed(self) -> None:
+        # コミット後に版数を上げる（それまでに他の接続の変更がなければ、この接続は最新のまま）
+        up_to_date = self._version == _history_versions.get(self.chat_id, 0)
+        version = invalidate_history(self.chat_id)
+        if up_to_date:
+            self._version = version
+
+
+def _is_sqlite() -> bool:
+    return database.url.dialect == "sqlite"
+
+
+async def configure_database() -> None:
+    """起動時に WAL モードを有効にする（データベースファイルに保存される）"""
+    if _is_sqlite():
+        await database.execute("PRAGMA journal_mode=WAL")
+
+
+# PRAGMA を設定済みの接続
+_configured_connections = weakref.WeakSet()
+
+
+@asynccontextmanager
+async def write_transaction():
+    """書き込み用のトランザクション（まとめて1回のコミットになる）"""
+    async with database.connection() as connection:
+        raw = connection.raw_connection
+        if _is_sqlite() and raw not in _configured_connections:
+            # トランザクションの中では変更できないため先に設定する
+            for name, value in SQLITE_PRAGMAS.items():
+                await connection.execute(f"PRAGMA {name}={value}")
+            _configured_connections.add(raw)
+        async with connection.transaction():
+            yield connection
+
+
+async def execute_writes(queries: list) -> None:
+    """複数の書き込みを1つのトランザクションで実行する"""
+    async with write_transaction() as connection:
+        for query in queries:
+            await connection.execute(query)
+
+
+class WriteBehindQueue:
+    """書き込みをキューに溜め、バックグラウンドでまとめてコミットする
+
+    複数の接続のターンを1つのトランザクションに束ねることで、fsync と書き込みロックの
+    回数を減らす。submit() はキューに入れるだけで、コミットを待つ場合は返り値を await する。
+    """
+
+    def __init__(self, interval: float = DB_WRITE_BATCH_INTERVAL, batch_size: int = DB_WRITE_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, queries: list) -> asyncio.Future:
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((queries, future))
+        return future
+
+    async def flush(self) -> None:
+        """キューに入っている書き込みがすべてコミットされるまで待つ"""
+        if self._task is not None:
+            await asyncio.shield(self.submit([]))
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._commit(batch)
+
+    async def _commit(self, batch) -> None:
+        try:
+            await execute_writes([query for queries, _ in batch for query in queries])
+        except Exception as e:
+            # まとめたうちの1件の失敗で他のターンを失わないよう個別にやり直す
+            print(f"Batched write failed, retrying individually: {e}")
+            for queries, future in batch:
+                try:
+                    await execute_writes(queries)
+                except Exception as item_error:
+                    if not future.done():
+                        future.set_exception(item_error)
+                else:
+                    if not future.done():
+                        future.set_result(None)
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+
+_writer: Optional[WriteBehindQueue] = None
+
+
+def get_writer() -> Optional[WriteBehindQueue]:
+    """write-behind が有効なら共有のキューを返す"""
+    global _writer
+    if DB_WRITE_BEHIND and _writer is None:
+        _writer = WriteBehindQueue()
+    return _writer
+
+
+async def close_writer() -> None:
+    """残っている書き込みをコミットしてキューを止める（終了時に呼ぶ）"""
+    if _writer is not None:
+        await _writer.close()
+
+
+async def write(queries: list, on_commit: Optional[Callable[[], None]] = None) -> None:
+    """書き込みを実行する（write-behind が有効ならキューに入れるだけ）
+
+    on_commit はコミットの後に呼ぶ（write-behind の場合はバックグラウンドでコミットされた後）。
+    """
+    writer = get_writer()
+    if writer is None:
+        await execute_writes(queries)
+        if on_commit is not None:
+            on_commit()
+    else:
+        future = writer.submit(queries)
+        # 結果を待たない場合でも失敗はログに残す
+        future.add_done_callback(lambda f: _after_write(f, on_commit))
+
+
+def _after_write(future: asyncio.Future, on_commit: Optional[Callable[[], None]]) -> None:
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        print(f"Error while writing messages: {future.exception()}")
+    elif on_commit is not None:
+        on_commit()
+
+
+async def save_message(
+    chat_id: int,
+    role: str,
+    content: str,
+    timestamp: Optional[datetime] = None,
+    touch_chat: bool = True,
+    on_commit: Optional[Callable[[], None]] = None,
+) -> None:
+    """メッセージ1件を保存する（touch_chat=True なら会話の更新日時も同じトランザクションで更新）
+
+    1ターンでは、発言は応答を待たずに単独で保存し（途中で落ちても失われないように）、
+    応答と会話の更新日時を次の1回のコミットでまとめて保存する。
+    会話一覧のキャッシュはコミットされてから捨てる。
+    """
+    now = datetime.utcnow()
+    queries = [
+        messages_table.insert().values(
+            chat_id=chat_id, role=role, content=content, timestamp=timestamp or now
+        )
+    ]
+    if touch_chat:
+        queries.append(chats_table.update().where(chats_table.c.id == chat_id).values(updated_at=now))
+
+    def committed():
+        if touch_chat:
+            chat_list_cache.invalidate()
+        if on_commit is not None:
+            on_commit()
+
+    await write(queries, on_commit=committed)
+
+
+async def touch_chat(chat_id: int) -> None:
+    """会話の更新日時だけを更新する（応答を保存できなかったターン用）"""
+    query = chats_table.update().where(chats_table.c.id == chat_id).values(updated_at=datetime.utcnow())
+    await write([query], on_commit=chat_list_cache.invalidate)
+
+
+async def delete_chat(chat_id: int) -> Optional[int]:
+    """会話とそのメッセージを削除し、次に表示する会話の ID を返す"""
+    writer = get_writer()
+    if writer is not None:
+        # キューに残っているこの会話への書き込みを先に済ませる
+        await writer.flush()
+    async with write_transaction() as connection:
+        await connection.execute(messages_table.delete().where(messages_table.c.chat_id == chat_id))
+        await connection.execute(chats_table.delete().where(chats_table.c.id == chat_id))
+        latest = await connection.fetch_val(
+            select(chats_table.c.id)
+            .order_by(chats_table.c.updated_at.desc(), chats_table.c.id.desc())
+            .limit(1)
+        )
+    chat_list_cache.invalidate()
+    invalidate_history(chat_id)
+    return latest
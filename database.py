@@ -1,18 +1,18 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+import os
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateIndex, CreateTable
 from datetime import datetime
 import databases
 
-# データベースURL
-DATABASE_URL = "sqlite:///./chat_history.db"
+# データベースURL（PostgreSQL などでは ?min_size=&max_size= で接続プールの大きさを指定できる）
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat_history.db").strip()
 
-# databases インスタンスの作成
+# databases インスタンスの作成（接続はアプリの起動時に行う）
 database = databases.Database(DATABASE_URL)
 
-# SQLAlchemy設定
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# SQLAlchemy設定（テーブル定義のみ。クエリはすべて databases 経由の非同期で実行する）
 Base = declarative_base()
 
 class Chat(Base):
@@ -24,6 +24,9 @@ class Chat(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     messages = relationship("ChatMessage", back_populates="chat")
 
+    # 会話一覧は更新日時の新しい順に並べる
+    __table_args__ = (Index("ix_chats_updated_at_id", "updated_at", "id"),)
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
 
@@ -34,13 +37,25 @@ class ChatMessage(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     chat = relationship("Chat", back_populates="messages")
 
-# データベースのテーブルを作成
-Base.metadata.create_all(bind=engine)
+    # 会話ごとのメッセージを時刻順に取り出す
+    __table_args__ = (Index("ix_chat_messages_chat_id_timestamp", "chat_id", "timestamp", "id"),)
+
+async def migrate():
+    """テーブルとインデックスがなければ作成する
+
+    既存のデータベースにも後から追加したインデックスを作る。
+    """
+    for table in Base.metadata.sorted_tables:
+        await database.execute(CreateTable(table, if_not_exists=True))
+        for index in table.indexes:
+            await database.execute(CreateIndex(index, if_not_exists=True))
+
+
+async def connect_database():
+    """データベースに接続してスキーマを最新にする（起動時に呼ぶ）"""
+    await database.connect()
+    await migrate()
+
 
-# データベース接続のセッションを取得する関数
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def disconnect_database():
+    await database.disconnect()
@@ -0,0 +1,139 @@
+import os
+import sys
+import asyncio
+import threading
+from typing import Awaitable, Callable, List, Optional
+
+from speech_pipeline import speak_sentences
+
+# 読み上げが追いつかないときの扱い: merge（まとめて読む）, drop-oldest（古い行を捨てる）,
+# summarize（捨てた行の件数だけ読む）
+STREAM_POLICY = os.getenv("STREAM_POLICY", "merge").strip()
+# 読み上げ待ちにしておく行の上限（合成済み・再生中の分は含まない）
+STREAM_MAX_PENDING = int(os.getenv("STREAM_MAX_PENDING", "3"))
+# merge でまとめた行の最大文字数（超えた分は古い行から捨てる）
+STREAM_MERGE_MAX_CHARS = int(os.getenv("STREAM_MERGE_MAX_CHARS", "200"))
+
+POLICIES = ("merge", "drop-oldest", "summarize")
+
+
+class LineBuffer:
+    """読み上げ待ちの行を溜めるバッファ
+
+    直前と同じ行は読まない。待ちが max_pending 行を超えたら policy に従って減らす。
+    """
+
+    def __init__(self, policy: str = STREAM_POLICY, max_pending: int = STREAM_MAX_PENDING):
+        if policy not in POLICIES:
+            raise ValueError(f"未対応のポリシー '{policy}' が指定されています（{', '.join(POLICIES)}）")
+        self.policy = policy
+        self.max_pending = max(1, max_pending)
+        self._pending: List[str] = []
+        # 待っている各発話に含まれる元の行数（まとめた発話は2以上）
+        self._weights: List[int] = []
+        self._last: Optional[str] = None
+        self._skipped = 0
+        self._closed = False
+        self._changed = asyncio.Event()
+        self.received = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.merged = 0
+
+    def push(self, line: str) -> None:
+        line = " ".join(line.split())
+        if not line:
+            return
+        self.received += 1
+        if line == self._last:
+            self.duplicates += 1
+            return
+        self._last = line
+        self._pending.append(line)
+        self._weights.append(1)
+        if len(self._pending) > self.max_pending:
+            self._overflow()
+        self._changed.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._changed.set()
+
+    def _overflow(self) -> None:
+        if self.policy == "merge":
+            # 待っている行を1つの発話にまとめる（長すぎる場合は古い行から捨てる）
+            # merged はまとめた発話に入った元の行数（まとめ直しで二重に数えない）
+            lines, weights = self._pending, self._weights
+            while len(lines) > 1 and sum(len(l) + 1 for l in lines) > STREAM_MERGE_MAX_CHARS:
+                self._drop(weights[0])
+                lines, weights = lines[1:], weights[1:]
+            if len(lines) > 1:
+                self.merged += sum(w for w in weights if w == 1)
+            self._pending = ["。".join(l.rstrip("。") for l in lines)]
+            self._weights = [sum(weights)]
+        else:
+            self._pending.pop(0)
+            self._drop(self._weights.pop(0))
+            if self.policy == "summarize":
+                self._skipped += 1
+
+    def _drop(self, weight: int) -> None:
+        """元の行数 weight の発話を捨てたことを数える（まとめた発話なら merged から移す）"""
+        self.dropped += weight
+        if weight > 1:
+            self.merged -= weight
+
+    async def get(self) -> Optional[str]:
+        """次に読む行を返す（入力が終わって空なら None）"""
+        while True:
+            if self._skipped:
+                count, self._skipped = self._skipped, 0
+                return f"{count}件のメッセージを省略しました。"
+            if self._pending:
+                self._weights.pop(0)
+                return self._pending.pop(0)
+            if self._closed:
+                return None
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def __aiter__(self):
+        while True:
+            line = await self.get()
+            if line is None:
+                return
+            yield line
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "merged": self.merged,
+        }
+
+
+def _read_lines(stream, buffer: LineBuffer, loop: asyncio.AbstractEventLoop) -> None:
+    try:
+        for line in stream:
+            loop.call_soon_threadsafe(buffer.push, line)
+    finally:
+        loop.call_soon_threadsafe(buffer.close)
+
+
+async def speak_lines(
+    buffer: LineBuffer,
+    display: Callable[[str, object], Awaitable[None]],
+    stream=None,
+    **speech_kwargs,
+) -> None:
+    """入力を1行ずつ読み上げる（次の行は前の行の再生中に合成しておく）
+
+    入力は別スレッドで読み、読み上げが追いつかない間に届いた行は buffer のポリシーで減らす。
+    """
+    loop = asyncio.get_event_loop()
+    reader = threading.Thread(
+        target=_read_lines, args=(stream or sys.stdin, buffer, loop), daemon=True
+    )
+    reader.start()
+    await speak_sentences(buffer, display, **speech_kwargs)
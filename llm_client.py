@@ -0,0 +1,169 @@
+import os
+import json
+import asyncio
+from typing import AsyncIterator, Dict, List, Optional
+
+import aiohttp
+from openai import AsyncOpenAI
+
+# 応答の長さと温度（全エンジン共通）
+LLM_MAX_TOKENS = 250
+LLM_TEMPERATURE = 0.7
+
+
+class LLMEngineError(Exception):
+    """LLM エンジンがエラーを返した"""
+
+
+class OpenAIChatEngine:
+    """OpenAI 互換 API（OpenAI, LM Studio）のストリーミングクライアント
+
+    AsyncOpenAI クライアントは最初の呼び出しで作り、以後使い回す。
+    """
+
+    def __init__(self, model: str, api_key: Optional[str] = None, base_url: Optional[str] = None):
+        self.model = model
+        self._api_key = api_key
+        self._base_url = base_url
+        self._client: Optional[AsyncOpenAI] = None
+
+    def _get_client(self) -> AsyncOpenAI:
+        if self._client is None:
+            self._client = AsyncOpenAI(api_key=self._api_key, base_url=self._base_url)
+        return self._client
+
+    async def stream(
+        self,
+        messages: List[dict],
+        max_tokens: int = LLM_MAX_TOKENS,
+        temperature: float = LLM_TEMPERATURE,
+    ) -> AsyncIterator[str]:
+        """応答をトークン単位のテキスト片で返す"""
+        response = await self._get_client().chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+        )
+        try:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # 途中で打ち切られた場合も接続を閉じて生成を止めさせる
+            await response.close()
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class OllamaChatEngine:
+    """Ollama の /api/chat のストリーミングクライアント
+
+    keep-alive の ClientSession をイベントループごとに1つ使い回す。
+    """
+
+    def __init__(self, model: str, url: str):
+        self.model = model
+        self.url = url.rstrip("/")
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=60)
+            )
+            self._loop = loop
+        return self._session
+
+    async def stream(
+        self,
+        messages: List[dict],
+        max_tokens: int = LLM_MAX_TOKENS,
+        temperature: float = LLM_TEMPERATURE,
+    ) -> AsyncIterator[str]:
+        """応答をトークン単位のテキスト片で返す"""
+        session = self._get_session()
+        async with session.post(
+            f"{self.url}/api/chat",
+            json={
+                "model": self.model,
+                "messages": [{"role": m["role"], "content": m["content"]} for m in messages],
+                "stream": True,
+                "options": {"temperature": temperature, "num_predict": max_tokens},
+            },
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise LLMEngineError(f"Ollama API error ({response.status}): {error_text}")
+
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if "error" in data:
+                    raise LLMEngineError(f"Ollama API error: {data['error']}")
+                content = data.get("message", {}).get("content")
+                if content:
+                    yield content
+                if data.get("done"):
+                    break
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+_engines: Dict[str, object] = {}
+
+
+def _create_engine(name: str):
+    if name == "openai":
+        return OpenAIChatEngine(
+            model=os.getenv("OPENAI_MODEL", "gpt-4o-mini").strip(),
+            api_key=os.getenv("OPENAI_API_KEY"),
+        )
+    if name == "ollama":
+        return OllamaChatEngine(
+            model=os.getenv("OLLAMA_MODEL", "phi4:latest").strip(),
+            url=os.getenv("OLLAMA_URL", "http://localhost:11434").strip(),
+        )
+    if name == "lm_studio":
+        # LM StudioはOpenAI互換APIなのでAsyncOpenAIクライアントを使用
+        url = os.getenv("LM_STUDIO_URL", "http://localhost:1234").strip()
+        return OpenAIChatEngine(
+            model=os.getenv("LM_STUDIO_MODEL", "openai/gpt-oss-20b").strip(),
+            api_key="lm-studio",
+            base_url=f"{url}/v1",
+        )
+    raise ValueError(f"未対応のエンジン '{name}' が指定されています")
+
+
+def get_engine(name: Optional[str] = None):
+    """エンジン名（未指定時は環境変数 ENGINE）に対応する共有クライアントを返す
+
+    環境変数は初回の呼び出し時に読む（.env の読み込み後に呼ぶこと）。
+    """
+    if name is None:
+        name = os.getenv("ENGINE", "openai").strip()
+    engine = _engines.get(name)
+    if engine is None:
+        engine = _create_engine(name)
+        _engines[name] = engine
+    return engine
+
+
+async def close_engines() -> None:
+    """共有クライアントをすべて閉じる（終了時に呼ぶ）"""
+    for engine in list(_engines.values()):
+        await engine.close()
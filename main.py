@@ -1,23 +1,7 @@
 import os
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, WebSocket, HTTPException
-from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
-from openai import AsyncOpenAI
-from speech import speech
-import json
-import asyncio
-from database import database, Chat, ChatMessage
-from datetime import datetime
-import pytz
-import aiohttp
-from pydantic import BaseModel
-from starlette.websockets import WebSocketDisconnect
-import traceback
-
-# 環境変数の読み込み
 
+# 環境変数の読み込み（各モジュールが import 時に設定を読むため、先に読み込む）
 print("Current working directory:", os.getcwd())
 print("Loading .env file...")
 env_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -31,18 +15,74 @@ if os.getenv("ENGINE") == "openai":
 elif os.getenv("ENGINE") == "ollama":
     print("OLLAMA_MODEL:", os.getenv("OLLAMA_MODEL"))
 
+from fastapi import FastAPI, Request, WebSocket, HTTPException, Query
+from fastapi.templating import Jinja2Templates
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, RedirectResponse
+from speech import synthesis_stats
+from speech_pipeline import speak_sentences
+from speech_timing import reveal_index
+from sentence_segmenter import iter_sentences
+from aivis_client import close_clients
+from speaker_warmup import get_warmer, close_warmer
+from llm_client import get_engine, close_engines
+from prompt_context import PromptContext
+from websocket_audio import AUDIO_DELIVERY, WebSocketAudioSink, parse_client_message
+import chat_store
+import chat_search
+from chat_store import (
+    CHAT_LIST_PAGE_SIZE,
+    MESSAGE_PAGE_SIZE,
+    HistoryWindow,
+    chat_list_cache,
+    cursor_params,
+    get_chat,
+    get_message_chat_id,
+    get_sidebar_chats,
+    invalidate_history,
+    list_chats,
+    list_messages,
+    parse_cursor,
+)
+import asyncio
+from contextlib import asynccontextmanager
+from database import database, connect_database, disconnect_database, Chat, ChatMessage
+from datetime import datetime
+from typing import Optional
+import pytz
+from pydantic import BaseModel
+from starlette.websockets import WebSocketDisconnect
+import traceback
+
 if os.getenv("DEBUG", "False").strip() == "True":
     DEBUG = True
 else:
     DEBUG = False
 
 # エンジンの設定を読み込み
-ENGINE = os.getenv("ENGINE", "openai").strip()  # openai, ollama
-OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini").strip()
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434").strip()
-OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "phi4").strip()
+ENGINE = os.getenv("ENGINE", "openai").strip()  # openai, ollama, lm_studio
+
+@asynccontextmanager
+async def lifespan(app):
+    # 起動時にデータベースへ接続してスキーマを確認する（import 時にはディスクに触れない）
+    await connect_database()
+    await chat_search.migrate_search()
+    await chat_store.configure_database()
+    # 最初の利用者の1文目でモデルの読み込みを待たせないよう、話者を先に準備しておく
+    warmer = get_warmer()
+    await warmer.warm()
+    warmer.start()
+    try:
+        yield
+    finally:
+        await close_warmer()
+        await close_clients()
+        await close_engines()
+        await chat_store.close_writer()
+        await disconnect_database()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 静的ファイルとテンプレートの設定
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -59,36 +99,67 @@ def convert_to_jst(dt):
     return dt.astimezone(jst)
 
 
-class ChatTitleUpdate(BaseModel):
-    title: str
+# テンプレートでは表示する値だけを変換する（{{ dt | jst }}）
+templates.env.filters["jst"] = convert_to_jst
 
 
-@app.on_event("startup")
-async def startup():
-    await database.connect()
+# システムプロンプト（毎回同じ先頭部分になるよう一度だけ作る）
+SYSTEM_PROMPT = """
+    あなたは、ご主人様に仕える優雅で愛らしいメイドです。ご主人様に対して親しみやすく、丁寧かつ温かみのある口調で応答してください。会話として自然でスムーズなテンポを保つため、応答は極力短く、簡潔にしてください。特に以下のルールを絶対に守ること:
+	1.	応答は2〜3文以内として、極力短く、簡潔にすること。
+	2.	列挙形式（番号(1,2,3...)や箇条書きを使わない。
+    3.  括弧を使った細く説明や例示をしない。
+    4.  「以下のポイント」「次の例」などの表現を使わない。
+    5.  教師や教育者、講師や識者のような喋り方はしない。
+	6.	ご主人様の言葉や感情に共感し、応答に愛らしさを含める。
 
+たとえば以下のような応答はしないように。
 
-@app.on_event("shutdown")
-async def shutdown():
-    await database.disconnect()
+「以下の点が挙げられます：
+1. **就寝前にリラックスする**: 読書や深呼吸、ゆっくりした音楽などで心を落ち着けましょう。
+2. **スマホの使用を控える**: ブルーライトが覚醒作用をもたらすことがあるため、就寝1時間前にはデバイスの使用を減らすのがおすすめです。
+3. **入浴をする**: 就寝1〜2時間前にぬるめのお風・・・
+」
+「
+- **暗く涼しい部屋**：明かりを消して、室温を少し下げると良いです。
+- **快適な枕や布団**：自分の体型に合った寝具を使うことで、より深く眠れます。
+- **スマホやテレビの使用を控える**：ブルーライトは睡眠リズムを乱す可能性があります。
+
+以上のルールを厳守し、ご主人様との会話を優雅で楽しいものにしてください。あくまでもご主人様の感情に寄り添って、然な口調で応答してください。
+"""
+prompt_context = PromptContext(SYSTEM_PROMPT)
+
+
+def request_cursor(before: Optional[str], before_id: Optional[int]):
+    """クエリパラメータのカーソルを解釈する（形式が不正なら 400）"""
+    try:
+        return parse_cursor(before, before_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class ChatTitleUpdate(BaseModel):
+    title: str
 
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root(request: Request):
-    # チャット一覧を取得
-    query = Chat.__table__.select().order_by(Chat.updated_at.desc())
-    chats = await database.fetch_all(query)
-
-    # 日時をJSTに変換
-    converted_chats = []
-    for chat in chats:
-        chat_dict = dict(chat)
-        chat_dict["created_at"] = convert_to_jst(chat_dict["created_at"])
-        chat_dict["updated_at"] = convert_to_jst(chat_dict["updated_at"])
-        converted_chats.append(chat_dict)
+async def read_root(
+    request: Request, before: Optional[str] = None, before_id: Optional[int] = None
+):
+    # チャット一覧を取得（更新日時のインデックスを使って1ページ分だけ読む）
+    cursor = request_cursor(before, before_id)
+    if cursor is None:
+        chats, next_cursor = await get_sidebar_chats()
+    else:
+        chats, next_cursor = await list_chats(before=cursor)
 
     return templates.TemplateResponse(
-        "chat_list.html", {"request": request, "chats": converted_chats}
+        "chat_list.html",
+        {
+            "request": request,
+            "chats": chats,
+            "next_page": cursor_params(next_cursor),
+        },
     )
 
 
@@ -99,60 +170,90 @@ async def create_chat():
         title="新しい会話", created_at=datetime.utcnow(), updated_at=datetime.utcnow()
     )
     chat_id = await database.execute(query)
+    chat_list_cache.invalidate()
     return RedirectResponse(url=f"/chat/{chat_id}", status_code=303)
 
 
 @app.get("/chat/{chat_id}", response_class=HTMLResponse)
 async def read_chat(request: Request, chat_id: int):
-    # チャット一覧を取得
-    chats_query = Chat.__table__.select().order_by(Chat.updated_at.desc())
-    chats = await database.fetch_all(chats_query)
-
-    # 日時をJSTに変換
-    converted_chats = []
-    for chat in chats:
-        chat_dict = dict(chat)
-        chat_dict["created_at"] = convert_to_jst(chat_dict["created_at"])
-        chat_dict["updated_at"] = convert_to_jst(chat_dict["updated_at"])
-        converted_chats.append(chat_dict)
+    # チャット一覧を取得（先頭ページはキャッシュを使う）
+    chats, next_chats = await get_sidebar_chats()
 
     # 現在のチャットの情報を取得
-    chat_query = Chat.__table__.select().where(Chat.id == chat_id)
-    chat = await database.fetch_one(chat_query)
+    chat = await get_chat(chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    # 現在のチャットの日時をJSTに変換
-    chat_dict = dict(chat)
-    chat_dict["created_at"] = convert_to_jst(chat_dict["created_at"])
-    chat_dict["updated_at"] = convert_to_jst(chat_dict["updated_at"])
-
-    # チャットのメッセージを取得
-    messages_query = (
-        ChatMessage.__table__.select()
-        .where(ChatMessage.chat_id == chat_id)
-        .order_by(ChatMessage.timestamp)
-    )
-    messages = await database.fetch_all(messages_query)
-
-    # メッセージの日時をJSTに変換
-    converted_messages = []
-    for message in messages:
-        message_dict = dict(message)
-        message_dict["timestamp"] = convert_to_jst(message_dict["timestamp"])
-        converted_messages.append(message_dict)
+    # チャットのメッセージを取得（最新のページのみ、古いものはスクロールで読み込む）
+    messages, next_messages = await list_messages(chat_id)
 
     return templates.TemplateResponse(
         "chat.html",
         {
             "request": request,
-            "chat": chat_dict,
-            "messages": converted_messages,
-            "chats": converted_chats,
+            "chat": chat,
+            "messages": messages,
+            "chats": chats,
+            "next_chats": cursor_params(next_chats),
+            "next_messages": cursor_params(next_messages),
+            "audio_delivery": AUDIO_DELIVERY,
         },
     )
 
 
+@app.get("/api/chats")
+async def api_list_chats(
+    before: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(CHAT_LIST_PAGE_SIZE, ge=1, le=200),
+):
+    """会話一覧の続きを返す"""
+    chats, next_cursor = await list_chats(limit, request_cursor(before, before_id))
+    return {
+        "chats": [{"id": chat["id"], "title": chat["title"]} for chat in chats],
+        "next": cursor_params(next_cursor),
+    }
+
+
+@app.get("/api/chats/{chat_id}/messages")
+async def api_list_messages(
+    chat_id: int,
+    before: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = Query(MESSAGE_PAGE_SIZE, ge=1, le=500),
+):
+    """指定位置より古いメッセージを返す（古い順）"""
+    messages, next_cursor = await list_messages(chat_id, limit, request_cursor(before, before_id))
+    return {
+        "messages": [
+            {"id": m["id"], "role": m["role"], "content": m["content"]} for m in messages
+        ],
+        "next": cursor_params(next_cursor),
+    }
+
+
+@app.get("/api/search")
+async def api_search(
+    q: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(chat_search.SEARCH_PAGE_SIZE, ge=1, le=100),
+):
+    """過去の会話を全文検索する（関連度順）"""
+    if not chat_search.search_available:
+        raise HTTPException(status_code=503, detail="Full-text search is not available")
+    results, has_more = await chat_search.search_messages(q, limit, offset)
+    return {
+        "results": results,
+        "next_offset": offset + limit if has_more else None,
+    }
+
+
+@app.get("/api/stats/speech")
+async def api_speech_stats():
+    """音声合成のキャッシュ・重複リクエストのまとめ・エンジンの状態"""
+    return synthesis_stats()
+
+
 @app.put("/chat/{chat_id}/title")
 async def update_chat_title(chat_id: int, title_update: ChatTitleUpdate):
     query = (
@@ -161,102 +262,46 @@ async def update_chat_title(chat_id: int, title_update: ChatTitleUpdate):
         .values(title=title_update.title, updated_at=datetime.utcnow())
     )
     await database.execute(query)
+    chat_list_cache.invalidate()
     return {"status": "success"}
 
 
 @app.delete("/chats/{chat_id}")
 async def delete_chat(chat_id: int):
     """チャットを削除する"""
-    # メッセージを削除
-    delete_messages_query = ChatMessage.__table__.delete().where(
-        ChatMessage.chat_id == chat_id
-    )
-    await database.execute(delete_messages_query)
-
-    # チャットを削除
-    delete_chat_query = Chat.__table__.delete().where(Chat.id == chat_id)
-    await database.execute(delete_chat_query)
-
-    # 直近の会話を取得
-    query = Chat.__table__.select().order_by(Chat.updated_at.desc())
-    latest_chat = await database.fetch_one(query)
+    # メッセージと会話の削除を1つのトランザクションで行う
+    next_chat_id = await chat_store.delete_chat(chat_id)
 
     return {
         "status": "success",
-        "next_chat_id": latest_chat.id if latest_chat else None,
+        "next_chat_id": next_chat_id,
     }
 
 
 @app.delete("/messages/{message_id}")
 async def delete_message(message_id: int):
     """メッセージを削除する"""
+    # 削除するメッセージの会話（接続中の履歴ウィンドウを読み直させる）
+    chat_id = await get_message_chat_id(message_id)
+
     # メッセージを削除
     delete_query = ChatMessage.__table__.delete().where(ChatMessage.id == message_id)
     await database.execute(delete_query)
+    if chat_id is not None:
+        invalidate_history(chat_id)
     return {"status": "success"}
 
 
-async def get_openai_response(messages):
-    """OpenAI APIからの応答をストリーミングで取得"""
-    if DEBUG:
-        print("Using OpenAI API with model:", OPENAI_MODEL)
-    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    async for chunk in await client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-        max_tokens=250,
-        temperature=0.7,
-        stream=True,
-    ):
-        if chunk.choices[0].delta.content is not None:
-            yield chunk.choices[0].delta.content
-
-
-
-
-async def get_ollama_response(messages):
-    """Ollama APIからの応答をストリーミングで取得"""
-    if DEBUG:
-        print("Using Ollama API with model:", OLLAMA_MODEL)
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{OLLAMA_URL}/api/generate",
-            json={
-                "model": OLLAMA_MODEL,
-                "prompt": messages[-1]["content"],
-                "stream": True,
-            },
-        ) as response:
-            if response.status != 200:
-                error_text = await response.text()
-                raise HTTPException(
-                    status_code=response.status,
-                    detail=f"Ollama API error: {error_text}",
-                )
-
-            try:
-                async for line in response.content:
-                    if not line:
-                        continue
-                    try:
-                        json_response = json.loads(line)
-                        if "response" in json_response:
-                            yield json_response["response"]
-                    except json.JSONDecodeError:
-                        continue
-            except Exception as e:
-                print(f"Error in streaming response: {e}")
-                raise
-
-
 async def display_with_speech(websocket, text, progress):
     """音声の進行に合わせて文字を表示"""
     total_chars = len(text)
     last_char_index = 0
 
+    current_sample = 0
+
     while not progress.is_finished:
-        current_ratio = progress.current_sample / progress.total_samples
-        target_char_index = int(current_ratio * total_chars)
+        # 再生位置に対応する文字数（モーラのタイミング索引があればそれを使う）
+        target_char_index = reveal_index(progress, current_sample, total_chars)
 
         if target_char_index > last_char_index:
             # 新しい文字を送信
@@ -264,7 +309,8 @@ async def display_with_speech(websocket, text, progress):
             await websocket.send_json({"type": "partial", "text": new_chars})
             last_char_index = target_char_index
 
-        await asyncio.sleep(0.01)
+        # 再生位置が進むまで待つ（ポーリングしない）
+        current_sample = await progress.wait_for_change(current_sample)
 
     # 残りの文字を送信
     if last_char_index < total_chars:
@@ -272,165 +318,182 @@ async def display_with_speech(websocket, text, progress):
         await websocket.send_json({"type": "partial", "text": remaining_chars})
 
 
-async def get_chat_history(chat_id):
-    """チャットの履歴を取得する"""
-    messages_query = (
-        ChatMessage.__table__.select()
-        .where(ChatMessage.chat_id == chat_id)
-        .order_by(ChatMessage.timestamp)
-    )
-    messages = await database.fetch_all(messages_query)
-    return [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+async def process_streaming_response(
+    websocket, response_generator, audio_sink=None, response_parts=None
+):
+    """ストリーミング応答を処理し、音声合成と表示を行う
 
-
-async def process_streaming_response(websocket, response_generator):
-    """ストリーミング応答を処理し、音声合成と表示を行う"""
-    full_response = ""
-    current_sentence = ""
-    current_progress = None
+    検出した文は SpeechPipeline で先読み合成し、前の文の再生中に
+    次の文の合成を進めることで文間の無音を短くする。
+    audio_sink を指定した場合は音声をサーバーで鳴らさずクライアントへ送る。
+    response_parts には受け取ったテキスト片を追加していく（取り消し時の保存用）。
+    """
+    if response_parts is None:
+        response_parts = []
     chunk_count = 0
 
-    try:
-        async for chunk in response_generator:
-            chunk_count += 1
-            if DEBUG:
-                print(f"Chunk {chunk_count}: {chunk}")
-
-            full_response += chunk
-            current_sentence += chunk
+    def on_chunk(chunk):
+        nonlocal chunk_count
+        chunk_count += 1
+        if DEBUG:
+            print(f"Chunk {chunk_count}: {chunk}")
+        response_parts.append(chunk)
 
-            # 文の終わりを検出
-            if any(current_sentence.endswith(d) for d in ["。", "！", "？", "!", "?"]):
-                if DEBUG:
-                    print(f"Complete sentence detected: {current_sentence}")
-
-                if current_progress is not None:
-                    # 前の音声が終わるのを待つ
-                    while not current_progress.is_finished:
-                        await asyncio.sleep(0.01)
+    async def sentences():
+        # 文の終わりを検出（チャンク途中の句点や閉じ括弧、長すぎる文も扱う）
+        async for sentence in iter_sentences(response_generator, on_chunk=on_chunk):
+            if DEBUG:
+                print(f"Complete sentence detected: {sentence}")
+            yield sentence
 
-                # 新しい文の音声合成を開始
-                current_progress = await speech(current_sentence)
-                await display_with_speech(websocket, current_sentence, current_progress)
-                current_sentence = ""
+    async def display(sentence, progress):
+        await display_with_speech(websocket, sentence, progress)
 
+    try:
+        await speak_sentences(
+            sentences(),
+            display,
+            play=audio_sink.play if audio_sink is not None else None,
+            stop=audio_sink.stop if audio_sink is not None else None,
+        )
     except Exception as e:
         print(f"Error in streaming response: {str(e)}")
         raise
 
-    # 残りの文を処理
-    if current_sentence.strip():
-        print(f"Processing remaining text: {current_sentence}")
-
-        if current_progress is not None:
-            while not current_progress.is_finished:
-                await asyncio.sleep(0.01)
-        current_progress = await speech(current_sentence)
-        await display_with_speech(websocket, current_sentence, current_progress)
-
     if DEBUG:
         print(f"Total chunks received: {chunk_count}")
-    return full_response
+    return "".join(response_parts)
 
 
 @app.websocket("/ws/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: int):
+async def websocket_endpoint(websocket: WebSocket, chat_id: int, audio: str = AUDIO_DELIVERY):
     await websocket.accept()
 
+    # audio=websocket の場合は音声をブラウザへ送り、再生位置をクライアントから受け取る
+    audio_sink = WebSocketAudioSink(websocket) if audio == "websocket" else None
+    incoming: asyncio.Queue = asyncio.Queue()
+
+    async def read_messages():
+        """受信を専用タスクで行い、応答中も再生位置の報告を受け取れるようにする"""
+        try:
+            while True:
+                message = parse_client_message(await websocket.receive_text())
+                if message is None:
+                    # 不正なフレームは捨てて受信を続ける
+                    if DEBUG:
+                        print("Ignoring malformed websocket message")
+                    continue
+                if audio_sink is not None and audio_sink.handle_client_message(message):
+                    continue
+                await incoming.put(message)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            print(f"Error while receiving websocket message: {e}")
+        finally:
+            if audio_sink is not None:
+                audio_sink.close()
+            await incoming.put(None)
+
+    reader = asyncio.ensure_future(read_messages())
+    # 直近の履歴は接続中メモリに保持し、毎ターンの読み直しを避ける
+    history = HistoryWindow(chat_id)
+
+    async def run_turn(user_message):
+        """1回の発言に応答する（取り消された場合もそれまでの応答を保存する）"""
+        user_timestamp = datetime.utcnow()
+        response_parts = []
+
+        # 発言は応答を待たずに保存する（応答の途中で落ちても発言は残る）
+        # 会話の更新日時は応答と一緒に更新する
+        await history.save("user", user_message, user_timestamp, touch_chat=False)
+
+        # LLMへのメッセージを構築（トークン予算に収まるよう古い履歴から落とす）
+        messages = prompt_context.build(await history.get())
+
+        # エンジンに応じたレスポンスジェネレータを選択（クライアントは使い回す）
+        print(f"Selected engine (after strip): '{ENGINE}'")
+        response_generator = get_engine(ENGINE).stream(messages)
+
+        # 応答を処理
+        try:
+            full_response = await process_streaming_response(
+                websocket, response_generator, audio_sink, response_parts
+            )
+            if DEBUG:
+                print(f"Full API response: {full_response}")
+        except asyncio.CancelledError:
+            # 割り込まれた場合は途中までの応答を保存する
+            partial = "".join(response_parts).strip()
+            if partial:
+                await history.save("assistant", partial)
+            else:
+                await chat_store.touch_chat(chat_id)
+            try:
+                await websocket.send_json({"type": "complete", "interrupted": True})
+            except Exception:
+                pass
+            raise
+        except BaseException as e:
+            if isinstance(e, Exception):
+                print(f"Error during API response processing: {str(e)}")
+                print(f"Error type: {type(e).__name__}")
+                print(f"Error details: {traceback.format_exc()}")
+                # 応答が得られなくても発言があったので会話の更新日時は進める
+                await chat_store.touch_chat(chat_id)
+            raise
+
+        # 余分なメッセージを削除（Ollama用）
+        if ENGINE == "ollama" and "banphrase" in full_response:
+            full_response = full_response.split("banphrase")[0].strip()
+
+        # 応答と会話の更新日時を1回のコミットで保存
+        await history.save("assistant", full_response)
+
+        # 完了通知を送信
+        await websocket.send_json({"type": "complete"})
+
+    async def interrupt(turn):
+        """応答中のターンを取り消し、保存が終わるまで待つ"""
+        turn.cancel()
+        try:
+            await turn
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Error while cancelling turn: {e}")
+
+    next_message = None
     try:
         while True:
             try:
                 # クライアントからのメッセージを受信
-                user_message = await websocket.receive_text()
-
-                # ユーザーメッセージをデータベースに保存
-                query = ChatMessage.__table__.insert().values(
-                    chat_id=chat_id,
-                    role="user",
-                    content=user_message,
-                    timestamp=datetime.utcnow(),
-                )
-                await database.execute(query)
-
-                # チャットの更新日時を更新
-                update_query = (
-                    Chat.__table__.update()
-                    .where(Chat.id == chat_id)
-                    .values(updated_at=datetime.utcnow())
-                )
-                await database.execute(update_query)
-
-                # チャット履歴を取得
-                history = await get_chat_history(chat_id)
-
-                # LLMへのメッセージを構築
-                messages = [
-                    {
-                        "role": "system",
-                        "content": """
-    あなたは、ご主人様に仕える優雅で愛らしいメイドです。ご主人様に対して親しみやすく、丁寧かつ温かみのある口調で応答してください。会話として自然でスムーズなテンポを保つため、応答は極力短く、簡潔にしてください。特に以下のルールを絶対に守ること:
-	1.	応答は2〜3文以内として、極力短く、簡潔にすること。
-	2.	列挙形式（番号(1,2,3...)や箇条書きを使わない。
-    3.  括弧を使った細く説明や例示をしない。
-    4.  「以下のポイント」「次の例」などの表現を使わない。
-    5.  教師や教育者、講師や識者のような喋り方はしない。
-	6.	ご主人様の言葉や感情に共感し、応答に愛らしさを含める。
-
-たとえば以下のような応答はしないように。
-
-「以下の点が挙げられます：
-1. **就寝前にリラックスする**: 読書や深呼吸、ゆっくりした音楽などで心を落ち着けましょう。
-2. **スマホの使用を控える**: ブルーライトが覚醒作用をもたらすことがあるため、就寝1時間前にはデバイスの使用を減らすのがおすすめです。
-3. **入浴をする**: 就寝1〜2時間前にぬるめのお風・・・
-」
-「
-- **暗く涼しい部屋**：明かりを消して、室温を少し下げると良いです。
-- **快適な枕や布団**：自分の体型に合った寝具を使うことで、より深く眠れます。
-- **スマホやテレビの使用を控える**：ブルーライトは睡眠リズムを乱す可能性があります。
-
-以上のルールを厳守し、ご主人様との会話を優雅で楽しいものにしてください。あくまでもご主人様の感情に寄り添って、然な口調で応答してください。
-""",
-                    },
-                ]
-                # 履歴を追加（最新の10件まで）
-                messages.extend(history[-10:])
-
-                # エンジンに応じたレスポンスジェネレータを選択
-                print(f"Selected engine (after strip): '{ENGINE}'")
-
-                if ENGINE == "openai":
-                    response_generator = get_openai_response(messages)
-                else:  # ollama
-                    response_generator = get_ollama_response(messages)
-
-                # 応答を処理
-                try:
-                    full_response = await process_streaming_response(
-                        websocket, response_generator
-                    )
-                    if DEBUG:
-                        print(f"Full API response: {full_response}")
-                except Exception as e:
-                    print(f"Error during API response processing: {str(e)}")
-                    print(f"Error type: {type(e).__name__}")
-                    print(f"Error details: {traceback.format_exc()}")
-                    raise
-
-                # 余分なメッセージを削除（Ollama用）
-                if ENGINE == "ollama" and "banphrase" in full_response:
-                    full_response = full_response.split("banphrase")[0].strip()
-
-                # アシスタントの応答をデータベースに保存
-                query = ChatMessage.__table__.insert().values(
-                    chat_id=chat_id,
-                    role="assistant",
-                    content=full_response,
-                    timestamp=datetime.utcnow(),
-                )
-                await database.execute(query)
-
-                # 完了通知を送信
-                await websocket.send_json({"type": "complete"})
+                message = next_message or await incoming.get()
+                next_message = None
+                if message is None:
+                    raise WebSocketDisconnect()
+                if message["type"] != "message":
+                    continue
+
+                # 応答中も受信を続け、新しい発言か stop が届いたら打ち切る
+                turn = asyncio.ensure_future(run_turn(message["content"]))
+                while not turn.done():
+                    receive = asyncio.ensure_future(incoming.get())
+                    await asyncio.wait({turn, receive}, return_when=asyncio.FIRST_COMPLETED)
+                    if not receive.done():
+                        receive.cancel()
+                        continue
+                    received = receive.result()
+                    if received is None or received["type"] in ("message", "stop"):
+                        if DEBUG:
+                            print("Interrupting the current response")
+                        await interrupt(turn)
+                        next_message = received
+                        if received is None:
+                            raise WebSocketDisconnect()
+                # 割り込みで取り消したターンは結果を見ずに次の発言へ進む
+                if not turn.cancelled():
+                    turn.result()
 
             except WebSocketDisconnect:
                 print("WebSocket disconnected")
@@ -446,6 +509,7 @@ async def websocket_endpoint(websocket: WebSocket, chat_id: int):
     except Exception as e:
         print(f"Websocket error: {e}")
     finally:
+        reader.cancel()
         try:
             await websocket.close()
         except:
@@ -0,0 +1,56 @@
+import os
+from functools import lru_cache
+from typing import List
+
+# システムプロンプトと履歴に使うトークン数の上限（応答の分は含まない）
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+
+# 1メッセージあたりの role などの付加分
+_MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（ASCII は4文字で1トークン、それ以外は1文字1トークン）
+
+    トークナイザを使わずに多めに見積もる。同じ文は毎ターン数え直さないようキャッシュする。
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"] or "") + _MESSAGE_OVERHEAD
+
+
+class PromptContext:
+    """システムプロンプトと履歴からトークン予算内のメッセージ列を作る
+
+    システムメッセージは一度だけ作って毎回同じものを先頭に置く（プロバイダ側の
+    プロンプトキャッシュが効くように、先頭部分を毎回まったく同じにする）。
+    予算を超える場合は古いやり取りから落とす。最新のメッセージは常に残す。
+    """
+
+    def __init__(self, system_prompt: str, budget: int = PROMPT_TOKEN_BUDGET):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = message_tokens(self.system_message)
+        self.budget = budget
+
+    def fit(self, history: List[dict]) -> List[dict]:
+        """予算に収まる直近の履歴を返す"""
+        remaining = self.budget - self.system_tokens
+        start = len(history)
+        while start > 0:
+            cost = message_tokens(history[start - 1])
+            if cost > remaining and start < len(history):
+                break
+            remaining -= cost
+            start -= 1
+        # 応答だけが先頭に残らないよう、ユーザーの発言から始める
+        while start < len(history) - 1 and history[start]["role"] == "assistant":
+            start += 1
+        return history[start:]
+
+    def build(self, history: List[dict]) -> List[dict]:
+        """LLM に渡すメッセージ列を返す"""
+        return [self.system_message, *self.fit(history)]
@@ -0,0 +1,174 @@
+import os
+import time
+import asyncio
+from typing import AsyncIterator, Callable, List, Optional
+
+# 強制的に区切る文の長さ（文字数、0で無効）
+SENTENCE_MAX_LENGTH = int(os.getenv("SENTENCE_MAX_LENGTH", "120"))
+# 入力が途切れてから未完の文を出すまでの秒数（0で無効）
+SENTENCE_FLUSH_TIMEOUT = float(os.getenv("SENTENCE_FLUSH_TIMEOUT", "2.0"))
+
+# 文末になる文字（連続した場合はまとめて1つの文末とみなす）
+_TERMINATORS = set("。！？!?…‥\n")
+# 文末の直後に続いても同じ文に含める閉じ括弧・引用符
+_CLOSERS = set("」』）)】〉》\"'”’")
+# 長すぎる文を強制的に区切るときに優先する位置
+_SOFT_BREAKS = set("、，, 　")
+
+
+class SentenceSegmenter:
+    """LLM のストリーミング出力から文を切り出す
+
+    feed() には新しく届いた文字列だけを渡し、走査もその分だけ行う。
+    文末記号の後に続く閉じ括弧や「……」「?!」などは同じ文に含め、
+    ASCII のピリオドは後ろが空白か終端のときだけ文末とみなす（"3.14" は区切らない）。
+    返す文をつなげると入力と完全に一致する。
+    """
+
+    def __init__(
+        self,
+        max_length: int = SENTENCE_MAX_LENGTH,
+        timeout: float = SENTENCE_FLUSH_TIMEOUT,
+    ):
+        self.max_length = max_length
+        self.timeout = timeout
+        self._parts: List[str] = []
+        self._length = 0
+        self._soft_break = 0
+        self._pending_end = False
+        self._pending_period = False
+        self._last_input = time.monotonic()
+
+    def feed(self, chunk: str) -> List[str]:
+        """文字列を追加し、確定した文のリストを返す"""
+        sentences = []
+        start = 0
+        for i, ch in enumerate(chunk):
+            if self._pending_end and not self._continues_end(ch):
+                if self._pending_period and not ch.isspace():
+                    # 英数字の途中のピリオドは文末ではない
+                    self._pending_end = self._pending_period = False
+                else:
+                    self._parts.append(chunk[start:i])
+                    start = i
+                    sentence = self._take()
+                    if sentence is not None:
+                        sentences.append(sentence)
+
+            self._length += 1
+            if ch in _TERMINATORS:
+                self._pending_end = True
+                self._pending_period = False
+            elif ch == "." and not self._pending_end:
+                self._pending_end = self._pending_period = True
+            elif ch in _SOFT_BREAKS:
+                self._soft_break = self._length
+
+            if self.max_length and self._length >= self.max_length and not self._pending_end:
+                self._parts.append(chunk[start:i + 1])
+                start = i + 1
+                sentences.append(self._split_long())
+
+        self._parts.append(chunk[start:])
+        self._last_input = time.monotonic()
+        return sentences
+
+    def flush(self) -> Optional[str]:
+        """未完の文を含めて残りをすべて返す（空白だけなら None）"""
+        text = "".join(self._parts)
+        self._reset()
+        return text if text.strip() else None
+
+    def time_until_flush(self) -> Optional[float]:
+        """timeout による強制出力までの残り秒数（待つものがなければ None）"""
+        if not self.timeout or not self._length:
+            return None
+        return max(0.0, self.timeout - (time.monotonic() - self._last_input))
+
+    def poll(self) -> Optional[str]:
+        """timeout を過ぎていれば未完の文を返す"""
+        remaining = self.time_until_flush()
+        if remaining is None or remaining > 0:
+            return None
+        return self.flush()
+
+    @staticmethod
+    def _continues_end(ch: str) -> bool:
+        return ch in _TERMINATORS or ch in _CLOSERS or ch == "."
+
+    def _take(self) -> Optional[str]:
+        text = "".join(self._parts)
+        if not text.strip():
+            # 空白だけの場合は次の文の先頭に回す
+            self._parts = [text]
+            self._pending_end = self._pending_period = False
+            return None
+        self._reset()
+        return text
+
+    def _split_long(self) -> str:
+        text = "".join(self._parts)
+        cut = self._soft_break or len(text)
+        self._reset()
+        rest = text[cut:]
+        if rest:
+            self._parts = [rest]
+            self._length = len(rest)
+        return text[:cut]
+
+    def _reset(self) -> None:
+        self._parts = []
+        self._length = 0
+        self._soft_break = 0
+        self._pending_end = False
+        self._pending_period = False
+
+
+def split_sentences(text: str, max_length: int = SENTENCE_MAX_LENGTH) -> List[str]:
+    """全文がそろっているテキストを文に分ける"""
+    segmenter = SentenceSegmenter(max_length=max_length, timeout=0)
+    sentences = [s for s in segmenter.feed(text) if s.strip()]
+    rest = segmenter.flush()
+    if rest is not None:
+        sentences.append(rest)
+    return sentences
+
+
+async def iter_sentences(
+    chunks: AsyncIterator[str],
+    segmenter: Optional[SentenceSegmenter] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+) -> AsyncIterator[str]:
+    """非同期のチャンク列から文を順に返す
+
+    入力が timeout 以上途切れた場合は未完の文もその時点で返す。
+    on_chunk には届いたチャンクがそのまま渡される。
+    """
+    if segmenter is None:
+        segmenter = SentenceSegmenter()
+    iterator = chunks.__aiter__()
+    next_chunk = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_chunk}, timeout=segmenter.time_until_flush())
+            if not done:
+                sentence = segmenter.poll()
+                if sentence is not None:
+                    yield sentence
+                continue
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            if on_chunk is not None:
+                on_chunk(chunk)
+            for sentence in segmenter.feed(chunk):
+                yield sentence
+            next_chunk = asyncio.ensure_future(iterator.__anext__())
+
+        rest = segmenter.flush()
+        if rest is not None:
+            yield rest
+    finally:
+        if not next_chunk.done():
+            next_chunk.cancel()
@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from aivis_client import AivisEnginePool, get_client
+
+# 起動時に準備しておく話者 ID（カンマ区切り、空で無効）
+WARMUP_SPEAKERS = os.getenv("WARMUP_SPEAKERS", "888753760").strip()
+# 話者の準備のあとに短い文を合成して、推論の初回の準備まで済ませる（0で無効）
+WARMUP_SYNTHESIS = os.getenv("WARMUP_SYNTHESIS", "1").strip() != "0"
+# 準備の合成に使う文
+WARMUP_TEXT = os.getenv("WARMUP_TEXT", "あ。").strip()
+# 合成がないまま、この秒数が過ぎたら準備し直す（0で準備し直さない）
+WARMUP_INTERVAL = float(os.getenv("WARMUP_INTERVAL", "600"))
+
+# 最後にエンジンで合成した時刻（準備し直すかどうかの判定に使う）
+_last_activity = time.monotonic()
+
+
+def note_activity() -> None:
+    """エンジンで合成したことを記録する"""
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+def parse_speakers(spec: str) -> List[int]:
+    return [int(item) for item in spec.split(",") if item.strip()]
+
+
+def _engine_clients(client) -> list:
+    # エンジンプールはどのエンジンに振り分けられても遅くならないよう、全エンジンを準備する
+    if isinstance(client, AivisEnginePool):
+        return [engine.client for engine in client.engines]
+    return [client]
+
+
+class SpeakerWarmer:
+    """話者のモデルをエンジンに読み込ませておく
+
+    エンジンは話者のモデルを初回の合成時に読み込むため、起動直後の最初の1文だけが
+    大きく遅れる。起動時に /initialize_speaker（と短い合成）を済ませておき、
+    合成がないまま interval 秒が過ぎたら準備し直す。
+    """
+
+    def __init__(
+        self,
+        speakers: List[int],
+        host: str = "127.0.0.1",
+        port: int = 10101,
+        synthesis: bool = WARMUP_SYNTHESIS,
+        interval: float = WARMUP_INTERVAL,
+    ):
+        self.targets: Set[Tuple[str, int, int]] = {(host, port, speaker) for speaker in speakers}
+        self.synthesis = synthesis
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self._last_warmup: Optional[float] = None
+        self.runs = 0
+        self.last_seconds: Optional[float] = None
+        self.timings: Dict[str, dict] = {}
+
+    def add(self, speaker: int, host: str = "127.0.0.1", port: int = 10101) -> None:
+        """準備し直す対象に話者を加える（実際に使われた話者も温めておく）"""
+        self.targets.add((host, port, speaker))
+
+    async def warm(self) -> dict:
+        """全対象を並行して準備し、対象ごとの所要時間（秒）を返す"""
+        started = time.monotonic()
+        jobs = []
+        for host, port, speaker in sorted(self.targets):
+            for client in _engine_clients(get_client(host, port)):
+                jobs.append(self._warm_one(client, speaker))
+        results = await asyncio.gather(*jobs)
+        self.last_seconds = time.monotonic() - started
+        self._last_warmup = time.monotonic()
+        self.runs += 1
+        self.timings = dict(results)
+        if results:
+            print(f"Speaker warm-up finished in {self.last_seconds:.2f}s: {self.timings}")
+        return self.timings
+
+    async def _warm_one(self, client, speaker: int) -> Tuple[str, dict]:
+        name = f"{client.base_url}#{speaker}"
+        timing = {}
+        started = time.monotonic()
+        try:
+            await client.initialize_speaker(speaker)
+            timing["initialize"] = round(time.monotonic() - started, 3)
+            if self.synthesis:
+                started = time.monotonic()
+                query = await client.audio_query(WARMUP_TEXT, speaker)
+                await client.synthesis(query, speaker)
+                timing["synthesis"] = round(time.monotonic() - started, 3)
+        except Exception as e:
+            # 準備に失敗しても本番の合成は動くので、記録だけして続ける
+            timing["error"] = f"{type(e).__name__}: {e}"
+        return name, timing
+
+    def start(self) -> None:
+        """合成が途絶えたときに準備し直す監視を始める"""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.ensure_future(self._keep_warm())
+
+    async def _keep_warm(self) -> None:
+        while True:
+            last = max(_last_activity, self._last_warmup or 0.0)
+            await asyncio.sleep(max(last + self.interval - time.monotonic(), 1.0))
+            if time.monotonic() - max(_last_activity, self._last_warmup or 0.0) >= self.interval:
+                await self.warm()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "last_seconds": round(self.last_seconds, 3) if self.last_seconds is not None else None,
+            "idle_seconds": round(time.monotonic() - _last_activity, 1),
+            "interval": self.interval,
+            "timings": self.timings,
+        }
+
+
+_warmer: Optional[SpeakerWarmer] = None
+
+
+def get_warmer() -> SpeakerWarmer:
+    """プロセス共有の SpeakerWarmer を返す（対象は WARMUP_SPEAKERS）"""
+    global _warmer
+    if _warmer is None:
+        _warmer = SpeakerWarmer(parse_speakers(WARMUP_SPEAKERS))
+    return _warmer
+
+
+def warmup_stats() -> Optional[dict]:
+    """準備の統計（まだ一度も使っていなければ None）"""
+    return _warmer.stats() if _warmer is not None else None
+
+
+async def close_warmer() -> None:
+    if _warmer is not None:
+        await _warmer.close()
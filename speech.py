@@ -1,83 +1,455 @@
+import os
 import sys
 import io
-import json
-import requests
-import pyaudio
 import numpy as np
-import threading
 import asyncio
+import itertools
+import threading
 from dataclasses import dataclass
 from typing import Optional
 
+import audio_trim
+import wav_format
+from aivis_client import get_client, close_clients
+from audio_player import get_player
+from synthesis_cache import get_cache, get_single_flight, make_key
+from speaker_warmup import note_activity, warmup_stats
+from speech_timing import TextTimeline
+from sentence_segmenter import split_sentences
+from wav_format import DEFAULT_SAMPLE_RATE, parse_wav
+
+# この文字数以上の文は分割して合成し、最初のチャンクから再生を始める
+STREAMING_MIN_CHARS = int(os.getenv("STREAMING_MIN_CHARS", "40"))
+# 読点がない場合に1チャンクにまとめるアクセント句の最大数
+STREAMING_MAX_PHRASES = int(os.getenv("STREAMING_MAX_PHRASES", "4"))
+# 複数の文をまとめて合成するときに /multi_synthesis を使う（0で無効）
+MULTI_SYNTHESIS = os.getenv("MULTI_SYNTHESIS", "1").strip() != "0"
+
+class _ProgressEvents:
+    """再生スレッドからの更新を asyncio の待機側へ通知する仕組み"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = []
+
+    def _notify(self) -> None:
+        # 再生スレッドから呼ばれるので、待機側のループへ call_soon_threadsafe で渡す
+        with self._lock:
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    async def wait_for_change(self, last_sample: int) -> int:
+        """current_sample が last_sample から進むか、再生が終わるまで待つ"""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            if self.is_finished or self.current_sample != last_sample:
+                return self.current_sample
+            self._waiters.append((loop, future))
+        await future
+        return self.current_sample
+
+    async def wait_finished(self) -> None:
+        """再生が終わるまで待つ"""
+        sample = -1
+        while not self.is_finished:
+            sample = await self.wait_for_change(sample)
+
+def _resolve(future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+class AudioProgress(_ProgressEvents):
+    """1発話の再生の進行状況
+
+    再生スレッドが update() / finish() で更新し、asyncio 側は
+    wait_for_change() / wait_finished() で更新があったときだけ起こされる。
+    timeline があれば文字表示はモーラの長さに合わせて進められる。
+    """
+
+    def __init__(
+        self,
+        total_samples: int,
+        parent: Optional[_ProgressEvents] = None,
+        timeline: Optional[TextTimeline] = None,
+    ):
+        super().__init__()
+        self.total_samples = total_samples
+        self.timeline = timeline
+        self._current_sample = 0
+        self._finished = False
+        self._parent = parent
+
+    @property
+    def current_sample(self) -> int:
+        return self._current_sample
+
+    @property
+    def is_finished(self) -> bool:
+        return self._finished
+
+    def update(self, current_sample: int) -> None:
+        self._current_sample = current_sample
+        self._publish()
+
+    def finish(self) -> None:
+        self._finished = True
+        self._publish()
+
+    def _publish(self) -> None:
+        self._notify()
+        if self._parent is not None:
+            self._parent._notify()
+
 @dataclass
-class AudioProgress:
-    total_samples: int
-    current_sample: int = 0
-    is_finished: bool = False
-
-def play_audio(audio_data, progress: AudioProgress, sample_rate=44100):
-    pya = pyaudio.PyAudio()
-    stream = pya.open(
-        format=pyaudio.paInt16,
-        channels=1,
-        rate=sample_rate,
-        output=True,
-        frames_per_buffer=128,
-    )
-    
-    # 最小限の無音データを書き込んでバッファを準備
-    silence = np.zeros(128, dtype=np.int16)
-    stream.write(silence.tobytes())
-    
-    # チャンク単位で音声データを書き込む
-    chunk_size = 128
-    for i in range(0, len(audio_data), chunk_size):
-        chunk = audio_data[i:i + chunk_size]
-        stream.write(chunk.tobytes())
-        progress.current_sample = i + chunk_size
-    
-    progress.is_finished = True
-    stream.stop_stream()
-    stream.close()
-    pya.terminate()
+class SynthesizedSpeech:
+    """合成済みの1文（PCM と文字表示用のタイミング索引、サンプルレート）"""
+    audio: np.ndarray
+    timeline: Optional[TextTimeline] = None
+    sample_rate: int = DEFAULT_SAMPLE_RATE
 
-async def speech(text, host='127.0.0.1', port=10101, speaker=888753760) -> AudioProgress:
-    params = {
-        'text': text,
-        'speaker': speaker,
+def play_audio(audio_data, progress: AudioProgress, sample_rate=DEFAULT_SAMPLE_RATE, group=None, owner=None):
+    """常駐プレイヤーの再生キューに音声を追加する（すぐに戻る）
+
+    1文を分割したチャンクは同じ group を渡し、チャンクの間でクロスフェードさせない。
+    owner を渡した発話は stop_playback(owner) でまとめて止められる。
+    """
+    get_player().enqueue(audio_data, progress, sample_rate, group, owner)
+
+_playback_owners = itertools.count(1)
+
+def new_playback_owner() -> int:
+    """再生をまとめて止めるための識別子を作る（1回の応答ごとに1つ使う）"""
+    return next(_playback_owners)
+
+def _trimmed_speech(voice, timeline: Optional[TextTimeline] = None) -> SynthesizedSpeech:
+    """/synthesis の WAV から前後の無音を削った音声と、削った分だけずらした文字表示の索引を返す"""
+    wav = parse_wav(voice)
+    audio, start = audio_trim.trim(wav.samples, wav.sample_rate)
+    if timeline is not None:
+        timeline = timeline.trimmed(start, len(audio))
+    return SynthesizedSpeech(audio, timeline, wav.sample_rate)
+
+def _cache_params(query_params, **extra) -> dict:
+    """キャッシュキーに含めるパラメータ（出力形式、前後の無音の長さや削り方の設定を含む）"""
+    return {
+        **wav_format.query_overrides(),
+        **audio_trim.cache_params(),
+        **(query_params or {}),
+        **extra,
     }
-    query = requests.post(
-        f'http://{host}:{port}/audio_query',
-        params=params,
+
+def _store_speech(cache, key, result: SynthesizedSpeech) -> SynthesizedSpeech:
+    meta = {"timeline": result.timeline.to_dict(), "sample_rate": result.sample_rate}
+    audio = cache.put(key, result.audio, meta=meta)
+    return SynthesizedSpeech(audio, result.timeline, result.sample_rate)
+
+async def synthesize(text, host='127.0.0.1', port=10101, speaker=888753760, query_params=None) -> np.ndarray:
+    """テキストを音声合成し、再生用の int16 配列を返す（再生はしない）
+
+    query_params は /audio_query の結果に上書きするパラメータ（speedScale など）。
+    同じ (テキスト, 話者, パラメータ) の結果はキャッシュから返す（読み取り専用）。
+    """
+    result = await _synthesize_speech(text, host, port, speaker, query_params)
+    return result.audio
+
+async def _cached_speech(cache, key) -> Optional[SynthesizedSpeech]:
+    audio, meta = await cache.get_entry_async(key)
+    if audio is None:
+        return None
+    meta = meta or {}
+    timeline = TextTimeline.from_dict(meta["timeline"]) if "timeline" in meta else None
+    return SynthesizedSpeech(audio, timeline, meta.get("sample_rate", DEFAULT_SAMPLE_RATE))
+
+async def _audio_query(client, text, speaker, query_params):
+    note_activity()
+    data = await client.audio_query(text, speaker)
+    # 文の前後の無音を短くして、文の切れ目の間を詰める
+    data.update(audio_trim.query_overrides())
+    data.update(wav_format.query_overrides())
+    if query_params:
+        data.update(query_params)
+    return data
+
+async def _synthesize_speech(text, host, port, speaker, query_params) -> SynthesizedSpeech:
+    cache = get_cache()
+    key = make_key(text, speaker, _cache_params(query_params))
+    cached = await _cached_speech(cache, key)
+    if cached is not None:
+        return cached
+
+    # 同じ文を同時に合成しようとしている呼び出しは1回の合成の結果を共有する
+    return await get_single_flight().run(
+        key, lambda: _synthesize_uncached(cache, key, text, host, port, speaker, query_params)
     )
-    data = query.json()
-    
-    synthesis = requests.post(
-        f'http://{host}:{port}/synthesis',
-        headers={'Content-Type': 'application/json'},
-        params=params,
-        data=json.dumps(data),
+
+async def _synthesize_uncached(cache, key, text, host, port, speaker, query_params) -> SynthesizedSpeech:
+    client = get_client(host, port)
+    data = await _audio_query(client, text, speaker, query_params)
+    voice = await client.synthesis(data, speaker)
+
+    return _store_speech(cache, key, _trimmed_speech(voice, TextTimeline.from_audio_query(text, data)))
+
+async def synthesize_batch(texts, host='127.0.0.1', port=10101, speaker=888753760, query_params=None):
+    """複数の文をまとめて合成し、SynthesizedSpeech のリストを同じ順で返す
+
+    キャッシュにない文の /audio_query は並行して呼び、合成はエンジンが対応していれば
+    /multi_synthesis の1回で、そうでなければ並行した /synthesis で行う。
+    """
+    cache = get_cache()
+    params = _cache_params(query_params)
+    keys = [make_key(text, speaker, params) for text in texts]
+    results = list(await asyncio.gather(*(_cached_speech(cache, key) for key in keys)))
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+
+    client = get_client(host, port)
+    queries = await asyncio.gather(
+        *(_audio_query(client, texts[i], speaker, query_params) for i in missing)
     )
-    voice = synthesis.content
 
-    # 音声データをnumpy配列に変換
-    audio_data = np.frombuffer(voice, dtype=np.int16).copy()
-    
-    # フェードイン用のカーブを作成（最初の10msに適用）
-    sample_rate = 44100
-    fade_duration = 0.01  # 10ms
-    fade_length = int(fade_duration * sample_rate)
-    fade_curve = np.linspace(0, 1, fade_length)
-    
-    # フェードインを適用
-    if len(audio_data) > fade_length:
-        audio_data[:fade_length] = audio_data[:fade_length] * fade_curve
-    
+    voices = None
+    if len(missing) > 1 and MULTI_SYNTHESIS and hasattr(client, "multi_synthesis"):
+        try:
+            voices = await client.multi_synthesis(list(queries), speaker)
+        except NotImplementedError:
+            voices = None
+    if voices is None:
+        # エンジンプールの場合は各エンジンに分散される
+        voices = await asyncio.gather(*(client.synthesis(query, speaker) for query in queries))
+
+    for i, query, voice in zip(missing, queries, voices):
+        result = _trimmed_speech(voice, TextTimeline.from_audio_query(texts[i], query))
+        results[i] = _store_speech(cache, keys[i], result)
+    return results
+
+def split_audio_query(query, max_phrases=STREAMING_MAX_PHRASES):
+    """audio_query の結果を読点（ポーズ）やアクセント句の区切りで分割する
+
+    最初の部分だけ prePhonemeLength、最後の部分だけ postPhonemeLength を残す。
+    """
+    groups = []
+    current = []
+    for phrase in query["accent_phrases"]:
+        current.append(phrase)
+        # 読点などのポーズ、またはアクセント句数の上限で区切る
+        if phrase.get("pause_mora") or len(current) >= max_phrases:
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+
+    parts = []
+    for i, group in enumerate(groups):
+        part = dict(query)
+        part["accent_phrases"] = group
+        if i > 0:
+            part["prePhonemeLength"] = 0.0
+        if i < len(groups) - 1:
+            part["postPhonemeLength"] = 0.0
+        parts.append(part)
+    return parts
+
+class ChunkedProgress(_ProgressEvents):
+    """分割再生される1文の進行状況（チャンクごとの AudioProgress をまとめる）
+
+    全チャンクがそろうまでは total_samples に見積もり値を使う。
+    """
+
+    def __init__(self, estimated_samples: int, timeline: Optional[TextTimeline] = None):
+        super().__init__()
+        self.estimated_samples = estimated_samples
+        self.timeline = timeline
+        self._parts = []
+        self._complete = False
+
+    def new_part(self, total_samples: int) -> AudioProgress:
+        """チャンク1つ分の進行状況を作って追加する"""
+        part = AudioProgress(total_samples=total_samples, parent=self)
+        self._parts.append(part)
+        self._notify()
+        return part
+
+    def complete(self) -> None:
+        self._complete = True
+        self._notify()
+
+    @property
+    def total_samples(self) -> int:
+        actual = sum(p.total_samples for p in self._parts)
+        if self._complete:
+            return actual
+        return max(actual, self.estimated_samples, 1)
+
+    @property
+    def current_sample(self) -> int:
+        return sum(p.current_sample for p in self._parts)
+
+    @property
+    def is_finished(self) -> bool:
+        return self._complete and all(p.is_finished for p in self._parts)
+
+class SynthesisStream:
+    """長い文を分割して順に合成し、届いたチャンクから再生できるようにする
+
+    無音を削るのは最初のチャンクの先頭と最後のチャンクの末尾だけ（チャンクの境目は削らない）。
+    再生中の文字表示は見積もりとの差を伸縮で吸収し、キャッシュには削った分に合わせた索引を残す。
+    """
+
+    def __init__(self, client, query, speaker, timeline: TextTimeline, on_complete=None):
+        self.timeline = timeline
+        self.estimated_samples = timeline.total_samples
+        # 最初のチャンクが届いたら実際の WAV の値に置き換える
+        self.sample_rate = query.get("outputSamplingRate", DEFAULT_SAMPLE_RATE)
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._feeder = None
+        self._drained = asyncio.Event()
+        self._task = asyncio.ensure_future(
+            self._synthesize(client, split_audio_query(query), speaker, on_complete)
+        )
+
+    async def _synthesize(self, client, parts, speaker, on_complete):
+        chunks = []
+        start = 0
+        try:
+            for i, part in enumerate(parts):
+                wav = parse_wav(await client.synthesis(part, speaker))
+                chunk, trimmed = audio_trim.trim(
+                    wav.samples, wav.sample_rate, head=(i == 0), tail=(i == len(parts) - 1)
+                )
+                if i == 0:
+                    start = trimmed
+                    self.sample_rate = wav.sample_rate
+                chunks.append(chunk)
+                self._chunks.put_nowait(chunk)
+        finally:
+            self._chunks.put_nowait(None)
+        if on_complete is not None and chunks:
+            audio = np.concatenate(chunks)
+            on_complete(SynthesizedSpeech(audio, self.timeline.trimmed(start, len(audio)), self.sample_rate))
+
+    async def iter_chunks(self):
+        """合成できたチャンクを順に返す（読み出せるのは1回だけ）"""
+        while True:
+            chunk = await self._chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        # 合成エラーはここで表面化させる
+        await self._task
+
+    async def drain(self, put) -> None:
+        """チャンクが届くたびに await put(chunk) で再生先へ渡す（読み出せるのは1回だけ）"""
+        try:
+            async for chunk in self.iter_chunks():
+                await put(chunk)
+        finally:
+            self._drained.set()
+
+    async def wait_drained(self) -> None:
+        """すべてのチャンクを再生先へ渡し終えるまで待つ（取り消し・エラーでも戻る）"""
+        await self._drained.wait()
+
+    def start_playback(self, owner=None) -> ChunkedProgress:
+        """チャンクが届くたびに再生キューへ追加する"""
+        progress = ChunkedProgress(self.estimated_samples, timeline=self.timeline)
+
+        async def put(chunk):
+            play_audio(chunk, progress.new_part(len(chunk)), self.sample_rate, group=progress, owner=owner)
+
+        async def feed():
+            try:
+                await self.drain(put)
+            finally:
+                progress.complete()
+
+        self._feeder = asyncio.ensure_future(feed())
+        return progress
+
+    def cancel(self) -> None:
+        """未合成のチャンクと再生キューへの追加を取り消す"""
+        self._task.cancel()
+        if self._feeder is not None:
+            self._feeder.cancel()
+
+async def prepare_speech(text, host='127.0.0.1', port=10101, speaker=888753760, query_params=None):
+    """再生の準備をする
+
+    短い文やキャッシュ済みの文は SynthesizedSpeech を、長い文は SynthesisStream を返す。
+    どちらも start_playback() にそのまま渡せる。
+    """
+    if len(text) < STREAMING_MIN_CHARS:
+        return await _synthesize_speech(text, host, port, speaker, query_params)
+
+    cache = get_cache()
+    key = make_key(text, speaker, _cache_params(query_params, chunked=True))
+    cached = await _cached_speech(cache, key)
+    if cached is not None:
+        return cached
+
+    client = get_client(host, port)
+    data = await _audio_query(client, text, speaker, query_params)
+    timeline = TextTimeline.from_audio_query(text, data)
+    return SynthesisStream(
+        client, data, speaker, timeline,
+        on_complete=lambda result: _store_speech(cache, key, result),
+    )
+
+def start_playback(audio_data, owner=None) -> AudioProgress:
+    """合成済みの音声を再生キューに追加し、進行状況オブジェクトを返す
+
+    SynthesisStream を渡した場合はチャンクが届くたびに順に再生する。
+    """
+    if isinstance(audio_data, SynthesisStream):
+        return audio_data.start_playback(owner)
+
+    timeline = None
+    sample_rate = DEFAULT_SAMPLE_RATE
+    if isinstance(audio_data, SynthesizedSpeech):
+        audio_data, timeline, sample_rate = audio_data.audio, audio_data.timeline, audio_data.sample_rate
+
     # 進行状況を追跡するオブジェクトを作成
-    progress = AudioProgress(total_samples=len(audio_data))
+    progress = AudioProgress(total_samples=len(audio_data), timeline=timeline)
     
-    # 別スレッドで音声を再生
-    thread = threading.Thread(target=play_audio, args=(audio_data, progress))
-    thread.start()
+    # 常駐プレイヤーで再生（前の発話の直後に途切れなく続く）
+    play_audio(audio_data, progress, sample_rate, owner=owner)
     
     return progress
+
+async def speech_batch(text, host='127.0.0.1', port=10101, speaker=888753760) -> AudioProgress:
+    """複数の文からなるテキストを文ごとにまとめて合成し、順に再生する
+
+    1文ずつ speech() を呼ぶと文の数だけ往復が直列に発生するため、先に全文を合成してから
+    再生キューに並べる。返す進行状況は全文の再生が終わると終了になる。
+    """
+    sentences = split_sentences(text)
+    speeches = await synthesize_batch(sentences, host=host, port=port, speaker=speaker)
+    progress = ChunkedProgress(sum(len(s.audio) for s in speeches))
+    for result in speeches:
+        play_audio(result.audio, progress.new_part(len(result.audio)), result.sample_rate)
+    progress.complete()
+    return progress
+
+def synthesis_stats() -> dict:
+    """合成キャッシュ、重複リクエストのまとめ（single-flight）、話者の準備の統計"""
+    stats = {"cache": get_cache().stats(), "coalescing": get_single_flight().stats()}
+    warmup = warmup_stats()
+    if warmup is not None:
+        stats["warmup"] = warmup
+    client = get_client()
+    if hasattr(client, "stats"):
+        stats["engines"] = client.stats()
+    return stats
+
+def stop_playback(owner=None) -> None:
+    """再生中と再生待ちの音声を止める（1ブロック以内に止まる）
+
+    owner を指定した場合は、その owner で再生を始めた音声だけを止める（他の接続の音声は止めない）。
+    """
+    get_player().cancel(owner)
+
+async def speech(text, host='127.0.0.1', port=10101, speaker=888753760) -> AudioProgress:
+    audio_data = await prepare_speech(text, host=host, port=port, speaker=speaker)
+    return start_playback(audio_data)
@@ -0,0 +1,316 @@
+"""avis_speech.py から使う常駐の読み上げデーモン
+
+Unix ドメインソケットで1行の JSON を受け取り、受け付けた順に合成・再生する。
+プレイヤーとエンジンへの接続はデーモンの間使い回すため、呼び出しごとに
+Python の起動や PortAudio の初期化を繰り返さない。
+
+クライアント側の関数（request_speech など）は標準ライブラリだけを使う。
+numpy などの重い依存はデーモンを起動したときにだけ読み込む。
+
+    python speech_daemon.py            # フォアグラウンドで起動
+    python speech_daemon.py --stats    # 統計を表示
+    python speech_daemon.py --stop     # 停止
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+# ソケットのパス
+AVIS_SPEECH_SOCKET = os.getenv(
+    "AVIS_SPEECH_SOCKET",
+    os.path.join(tempfile.gettempdir(), f"avis_speech-{os.getuid()}.sock"),
+).strip()
+# 何も依頼がないまま、この秒数が過ぎたらデーモンを終了する（0で終了しない）
+AVIS_SPEECH_DAEMON_IDLE = float(os.getenv("AVIS_SPEECH_DAEMON_IDLE", "600"))
+# 自動起動したデーモンの待ち受け開始を待つ秒数
+_START_TIMEOUT = 15.0
+
+
+class DaemonUnavailable(Exception):
+    """デーモンに接続できず、起動もできなかった"""
+
+
+# --- クライアント ---
+
+def _connect(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _start_daemon(path: str) -> None:
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--socket", path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def connect(path: str = AVIS_SPEECH_SOCKET, autostart: bool = True) -> socket.socket:
+    """デーモンに接続する（起動していなければ起動して待つ）"""
+    try:
+        return _connect(path)
+    except OSError:
+        if not autostart:
+            raise DaemonUnavailable(f"speech daemon is not running ({path})")
+    _start_daemon(path)
+    deadline = time.monotonic() + _START_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        try:
+            return _connect(path)
+        except OSError:
+            continue
+    raise DaemonUnavailable(f"speech daemon did not start ({path})")
+
+
+def _send(sock: socket.socket, message: dict) -> None:
+    sock.sendall(json.dumps(message, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+def _receive(stream) -> dict:
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("speech daemon closed the connection")
+    reply = json.loads(line)
+    if reply.get("status") == "error":
+        raise RuntimeError(reply.get("message", "speech daemon error"))
+    return reply
+
+
+def request_speech(
+    text: str,
+    host: str = "127.0.0.1",
+    port: int = 10101,
+    speaker: int = 888753760,
+    wait: bool = False,
+    on_started=None,
+    path: str = AVIS_SPEECH_SOCKET,
+) -> None:
+    """読み上げを依頼する
+
+    on_started を渡すと再生が始まるまで接続を保ち、始まった時点で呼ぶ。
+    wait=True なら再生が終わるまで待つ。どちらもなければ受け付けられた時点で戻る。
+    """
+    with connect(path) as sock:
+        _send(sock, {
+            "command": "speak",
+            "text": text,
+            "host": host,
+            "port": port,
+            "speaker": speaker,
+            "wait": wait,
+            "started": on_started is not None,
+        })
+        with sock.makefile("rb") as stream:
+            _receive(stream)
+            if on_started is None and not wait:
+                return
+            _receive(stream)
+            if on_started is not None:
+                on_started()
+            if wait:
+                _receive(stream)
+
+
+def request_command(command: str, path: str = AVIS_SPEECH_SOCKET) -> dict:
+    """stats / stop などのコマンドを送る（デーモンは起動しない）"""
+    with connect(path, autostart=False) as sock:
+        _send(sock, {"command": command})
+        with sock.makefile("rb") as stream:
+            return _receive(stream)
+
+
+# --- デーモン ---
+
+class SpeechDaemon:
+    """依頼を1本のキューで受け付け順に合成・再生する"""
+
+    def __init__(self, path: str = AVIS_SPEECH_SOCKET, idle_timeout: float = AVIS_SPEECH_DAEMON_IDLE):
+        import speech
+        import speaker_warmup
+
+        self.speech = speech
+        self.warmer = speaker_warmup.get_warmer()
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._last_activity = time.monotonic()
+        self._active = 0
+        self._stopped = asyncio.Event()
+        self.requests = 0
+
+    async def serve(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # ソケットは作られた時点から本人だけが接続できるようにする（bind のあとの chmod では間に合わない）
+        old_umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.path)
+        finally:
+            os.umask(old_umask)
+        worker = asyncio.ensure_future(self._work())
+        watcher = asyncio.ensure_future(self._watch_idle())
+        # 話者の準備は待ち受けを始めてから進める（自動起動のきっかけになった依頼を待たせない）
+        warmup = asyncio.ensure_future(self.warmer.warm())
+        self.warmer.start()
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            worker.cancel()
+            watcher.cancel()
+            warmup.cancel()
+            await self.warmer.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            await self.speech.close_clients()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._active += 1
+        self._last_activity = time.monotonic()
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+            try:
+                message = json.loads(line)
+                reply = await self._dispatch(message, writer)
+            except Exception as e:
+                reply = {"status": "error", "message": f"{type(e).__name__}: {e}"}
+            await self._reply(writer, reply)
+        finally:
+            self._active -= 1
+            self._last_activity = time.monotonic()
+            writer.close()
+
+    @staticmethod
+    async def _reply(writer: asyncio.StreamWriter, reply: dict) -> None:
+        writer.write(json.dumps(reply, ensure_ascii=False).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def _dispatch(self, message: dict, writer: asyncio.StreamWriter) -> dict:
+        command = message.get("command", "speak")
+        if command == "stats":
+            stats = self.speech.synthesis_stats()
+            stats["requests"] = self.requests
+            stats["queued"] = self._queue.qsize()
+            return {"status": "ok", "stats": stats}
+        if command == "stop":
+            self._stopped.set()
+            return {"status": "ok"}
+        if command != "speak":
+            raise ValueError(f"unknown command: {command}")
+
+        text = str(message.get("text", "")).strip()
+        if not text:
+            raise ValueError("text is empty")
+        self.requests += 1
+        done = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((message, text, done))
+        if not self._waits(message):
+            return {"status": "queued"}
+        # 待つ場合は受付の応答を返したうえで、再生の開始（と終了）まで接続を保つ
+        await self._reply(writer, {"status": "queued"})
+        progress = await done
+        await progress.wait_for_change(0)
+        if not message.get("wait"):
+            return {"status": "started"}
+        await self._reply(writer, {"status": "started"})
+        await progress.wait_finished()
+        return {"status": "finished"}
+
+    @staticmethod
+    def _waits(message: dict) -> bool:
+        """再生の開始か終了をクライアントが待っているか"""
+        return bool(message.get("wait") or message.get("started"))
+
+    async def _work(self) -> None:
+        """依頼を順に合成して再生キューに並べる（次の依頼の合成は前の再生中に進む）"""
+        while True:
+            message, text, done = await self._queue.get()
+            host = message.get("host", "127.0.0.1")
+            port = int(message.get("port", 10101))
+            speaker = int(message.get("speaker", 888753760))
+            self.warmer.add(speaker, host, port)
+            try:
+                progress = await self.speech.speech_batch(text, host=host, port=port, speaker=speaker)
+            except Exception as e:
+                print(f"Speech failed: {e}")
+                # 開始や終了を待っている依頼にだけエラーを返す
+                if self._waits(message) and not done.done():
+                    done.set_exception(e)
+                continue
+            if not done.done():
+                done.set_result(progress)
+            self._last_activity = time.monotonic()
+
+    async def _watch_idle(self) -> None:
+        if not self.idle_timeout:
+            return
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 30))
+            idle = time.monotonic() - self._last_activity
+            busy = self._active or not self._queue.empty() or self.speech.get_player().pending()
+            if idle >= self.idle_timeout and not busy:
+                self._stopped.set()
+                return
+
+
+def _lock(path: str):
+    """同じソケットで2つのデーモンが起動しないようロックを取る（取れなければ None）"""
+    import fcntl
+
+    lock_file = open(f"{path}.lock", "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def run_daemon(path: str = AVIS_SPEECH_SOCKET) -> int:
+    lock = _lock(path)
+    if lock is None:
+        print("speech daemon is already running")
+        return 0
+    try:
+        async def main():
+            await SpeechDaemon(path).serve()
+
+        asyncio.run(main())
+    finally:
+        lock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="avis_speech の常駐読み上げデーモン")
+    parser.add_argument("--socket", default=AVIS_SPEECH_SOCKET, help="ソケットのパス")
+    parser.add_argument("--stats", action="store_true", help="起動中のデーモンの統計を表示する")
+    parser.add_argument("--stop", action="store_true", help="起動中のデーモンを停止する")
+    args = parser.parse_args()
+    if args.stats or args.stop:
+        try:
+            reply = request_command("stats" if args.stats else "stop", args.socket)
+        except DaemonUnavailable as e:
+            print(e)
+            raise SystemExit(1)
+        if args.stats:
+            print(json.dumps(reply["stats"], ensure_ascii=False, indent=2))
+        raise SystemExit(0)
+    raise SystemExit(run_daemon(args.socket))
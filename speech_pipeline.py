@@ -0,0 +1,198 @@
+import os
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from speech import (
+    prepare_speech,
+    start_playback,
+    stop_playback,
+    synthesize_batch,
+    new_playback_owner,
+    SynthesisStream,
+)
+from sentence_segmenter import split_sentences
+
+# 再生待ちの文をいくつ先まで合成しておくか
+SPEECH_LOOKAHEAD = int(os.getenv("SPEECH_LOOKAHEAD", "2"))
+
+
+class SpeechPipeline:
+    """文単位の音声合成を先読みし、再生は投入順に1本のコンシューマで行う
+
+    put() された文は上限 lookahead 件まで並行して合成され、
+    play コールバックは (text, audio_data) を投入順に1件ずつ受け取る。
+    audio_data は speech.prepare_speech() の戻り値（配列または SynthesisStream）。
+    """
+
+    def __init__(
+        self,
+        play: Callable[[str, object], Awaitable[None]],
+        lookahead: int = SPEECH_LOOKAHEAD,
+        **speech_kwargs,
+    ):
+        self._play = play
+        self._speech_kwargs = speech_kwargs
+        # 合成中または再生待ちの文の数を制限する
+        self._slots = asyncio.Semaphore(max(1, lookahead))
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._consumer: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """再生コンシューマを起動する"""
+        if self._consumer is None:
+            self._consumer = asyncio.ensure_future(self._run())
+
+    async def put(self, text: str) -> None:
+        """文を投入して合成を開始する（先読みが上限のときは空きを待つ）"""
+        self.start()
+        acquire = asyncio.ensure_future(self._slots.acquire())
+        done, _ = await asyncio.wait(
+            {acquire, self._consumer}, return_when=asyncio.FIRST_COMPLETED
+        )
+        if acquire not in done:
+            # コンシューマが先に終了した（再生側のエラー）
+            acquire.cancel()
+            self._consumer.result()
+            raise RuntimeError("speech pipeline is closed")
+
+        task = asyncio.ensure_future(prepare_speech(text, **self._speech_kwargs))
+        self._queue.put_nowait((text, task))
+
+    async def finish(self) -> None:
+        """投入済みの文をすべて再生し終えるまで待つ"""
+        self.start()
+        self._queue.put_nowait(None)
+        await self._consumer
+
+    def cancel(self) -> None:
+        """未再生の合成と再生コンシューマを取り消す"""
+        if self._consumer is not None:
+            self._consumer.cancel()
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not None:
+                self._cancel_task(item[1])
+
+    @staticmethod
+    def _cancel_task(task: asyncio.Task) -> None:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            # 分割合成中のストリームは合成も止める
+            result = task.result()
+            if isinstance(result, SynthesisStream):
+                result.cancel()
+
+    async def _run(self) -> None:
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            text, task = item
+            try:
+                audio_data = await task
+            finally:
+                self._slots.release()
+            await self._play(text, audio_data)
+
+
+async def speak_sentences(
+    sentences: AsyncIterator[str],
+    display: Callable[[str, object], Awaitable[None]],
+    play: Optional[Callable[[object], Awaitable[object]]] = None,
+    stop: Optional[Callable[[], None]] = None,
+    **pipeline_kwargs,
+) -> None:
+    """文の列を先読み合成しながら順に再生し、display(sentence, progress) で表示する
+
+    次の文は前の文の再生中に再生先へ渡しておき、文間を空けずに鳴らす。
+    分割合成の文は、残りのチャンクをすべて再生先へ渡し終えてから次の文を渡す。
+    文字の表示は前の文の表示が終わってから始める。
+    play を省略した場合はこのマシンで再生する（speech.start_playback）。
+    途中で取り消された場合は合成を止め、stop（省略時は speech.stop_playback）で
+    この呼び出しで再生キューに入れた音声も止める。
+    """
+    displaying = None
+    # この呼び出しで再生キューに入れた音声（取り消し時に他の接続の音声は止めない）
+    owner = new_playback_owner()
+    # 再生を始めた分割合成（取り消し時に残りの合成も止める）
+    streams = []
+    # まだチャンクを再生先へ渡している途中の分割合成
+    feeding = None
+
+    async def play_sentence(sentence, audio_data):
+        nonlocal displaying, feeding
+        # 待っている間に取り消されても合成を止められるよう、先に登録する
+        if isinstance(audio_data, SynthesisStream):
+            streams.append(audio_data)
+        if feeding is not None:
+            # 前の文のチャンクの間に次の文が挟まらないよう、渡し終えるのを待つ
+            await feeding.wait_drained()
+            feeding = None
+        if play is not None:
+            progress = await play(audio_data)
+        else:
+            progress = start_playback(audio_data, owner)
+        if isinstance(audio_data, SynthesisStream):
+            feeding = audio_data
+        if displaying is not None:
+            await displaying
+        displaying = asyncio.ensure_future(display(sentence, progress))
+
+    pipeline = SpeechPipeline(play_sentence, **pipeline_kwargs)
+    pipeline.start()
+    try:
+        async for sentence in sentences:
+            await pipeline.put(sentence)
+        await pipeline.finish()
+        if displaying is not None:
+            await displaying
+    except BaseException:
+        pipeline.cancel()
+        for stream in streams:
+            stream.cancel()
+        if displaying is not None:
+            displaying.cancel()
+        if stop is not None:
+            stop()
+        elif play is None:
+            stop_playback(owner)
+        raise
+
+
+async def speak_text(
+    text: str,
+    display: Callable[[str, object], Awaitable[None]],
+    play: Optional[Callable[[object], Awaitable[object]]] = None,
+    stop: Optional[Callable[[], None]] = None,
+    **speech_kwargs,
+) -> None:
+    """全文がそろっている応答を文に分け、まとめて合成してから順に再生・表示する
+
+    ストリーミングしない場合に使う。文ごとの往復を直列に待たず、
+    speech.synthesize_batch() で全文を一度に合成する。
+    """
+    sentences = split_sentences(text)
+    if not sentences:
+        return
+    speeches = await synthesize_batch(sentences, **speech_kwargs)
+    owner = new_playback_owner()
+    displaying = None
+    try:
+        for sentence, audio_data in zip(sentences, speeches):
+            if play is not None:
+                progress = await play(audio_data)
+            else:
+                progress = start_playback(audio_data, owner)
+            if displaying is not None:
+                await displaying
+            displaying = asyncio.ensure_future(display(sentence, progress))
+        await displaying
+    except BaseException:
+        if displaying is not None:
+            displaying.cancel()
+        if stop is not None:
+            stop()
+        elif play is None:
+            stop_playback(owner)
+        raise
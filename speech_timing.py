@@ -0,0 +1,142 @@
+from bisect import bisect_right
+from typing import List, Optional
+
+# audio_query でポーズ（pause_mora）になる区切り文字
+_PAUSE_CHARS = set("、。，,．.！？!?…‥：:；;\n")
+# 区切り文字の直後に続く閉じ括弧・引用符（直前の区間に含める）
+_CLOSING_CHARS = set("」』）)】〉》\"'”’")
+
+
+def split_text_at_pauses(text: str) -> List[str]:
+    """テキストを読点・句点などの区切りごとに分割する（区切り文字は直前の区間に含める）"""
+    segments = []
+    current = []
+    seen_pause = False
+    for i, ch in enumerate(text):
+        current.append(ch)
+        if ch in _PAUSE_CHARS:
+            seen_pause = True
+        next_ch = text[i + 1] if i + 1 < len(text) else ""
+        if seen_pause and next_ch not in _PAUSE_CHARS and next_ch not in _CLOSING_CHARS:
+            segments.append("".join(current))
+            current = []
+            seen_pause = False
+    if current:
+        segments.append("".join(current))
+    return segments
+
+
+def _mora_length(mora: dict) -> float:
+    return (mora.get("consonant_length") or 0.0) + (mora.get("vowel_length") or 0.0)
+
+
+class TextTimeline:
+    """再生位置（サンプル）から表示済みにすべき文字数を引く索引
+
+    (サンプル位置, 文字数) の折れ線として持ち、参照は二分探索と線形補間で行う。
+    """
+
+    def __init__(self, samples: List[int], chars: List[int]):
+        self.samples = samples
+        self.chars = chars
+
+    @property
+    def total_samples(self) -> int:
+        return self.samples[-1]
+
+    def chars_at(self, sample: int, total_samples: Optional[int] = None) -> int:
+        """sample の時点で表示すべき文字数を返す
+
+        total_samples に実際の音声長を渡すと、見積もりとの差を伸縮で吸収する。
+        """
+        if total_samples and self.total_samples:
+            sample = sample * self.total_samples / total_samples
+        i = bisect_right(self.samples, sample) - 1
+        if i < 0:
+            return 0
+        if i >= len(self.samples) - 1:
+            return self.chars[-1]
+        start, end = self.samples[i], self.samples[i + 1]
+        if end <= start:
+            return self.chars[i + 1]
+        ratio = (sample - start) / (end - start)
+        return self.chars[i] + int(ratio * (self.chars[i + 1] - self.chars[i]))
+
+    def trimmed(self, start: int, length: Optional[int] = None) -> "TextTimeline":
+        """先頭から start サンプルを削り、length サンプルで打ち切った音声に合わせた索引を返す"""
+        end = self.total_samples - start if length is None else length
+        samples = [min(max(s - start, 0), end) for s in self.samples]
+        return TextTimeline(samples, list(self.chars))
+
+    def to_dict(self) -> dict:
+        return {"samples": self.samples, "chars": self.chars}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TextTimeline":
+        return cls(list(data["samples"]), list(data["chars"]))
+
+    @classmethod
+    def from_audio_query(cls, text: str, query: dict) -> "TextTimeline":
+        """audio_query のモーラ長とポーズから索引を作る
+
+        読点などの区切りごとにテキストとアクセント句の組を対応させ、
+        区切り内ではモーラの長さに応じて文字を進める。ポーズ中は文字を進めない。
+        対応が取れない場合はモーラ数の比で文字を割り振る。
+        """
+        scale = 1.0 / (query.get("speedScale") or 1.0)
+        rate = query.get("outputSamplingRate", 44100)
+
+        # ポーズで区切ったアクセント句のまとまり
+        groups = []
+        current = []
+        for phrase in query["accent_phrases"]:
+            current.append(phrase)
+            if phrase.get("pause_mora"):
+                groups.append(current)
+                current = []
+        if current:
+            groups.append(current)
+
+        segments = split_text_at_pauses(text)
+        mora_counts = [sum(len(p["moras"]) for p in group) for group in groups]
+        if len(segments) == len(groups):
+            group_chars = [len(segment) for segment in segments]
+        else:
+            total_moras = sum(mora_counts) or 1
+            group_chars = []
+            assigned = 0
+            for count in mora_counts:
+                assigned += count
+                group_chars.append(round(len(text) * assigned / total_moras))
+            group_chars = [b - a for a, b in zip([0] + group_chars[:-1], group_chars)]
+
+        seconds = query.get("prePhonemeLength", 0.0) * scale
+        samples = [0, int(seconds * rate)]
+        chars = [0, 0]
+        shown = 0
+        for group, n_chars, n_moras in zip(groups, group_chars, mora_counts):
+            done = 0
+            for phrase in group:
+                for mora in phrase["moras"]:
+                    seconds += _mora_length(mora) * scale
+                    done += 1
+                    samples.append(int(seconds * rate))
+                    chars.append(shown + n_chars * done // max(n_moras, 1))
+                if phrase.get("pause_mora"):
+                    # ポーズ中は文字を進めない
+                    seconds += _mora_length(phrase["pause_mora"]) * scale
+                    samples.append(int(seconds * rate))
+                    chars.append(shown + n_chars * done // max(n_moras, 1))
+            shown += n_chars
+        seconds += query.get("postPhonemeLength", 0.0) * scale
+        samples.append(int(seconds * rate))
+        chars.append(len(text))
+        return cls(samples, chars)
+
+
+def reveal_index(progress, sample: int, text_length: int) -> int:
+    """進行状況から表示すべき文字数を返す（索引がなければ再生位置の比率で求める）"""
+    timeline = getattr(progress, "timeline", None)
+    if timeline is not None:
+        return min(timeline.chars_at(sample, progress.total_samples), text_length)
+    return int(sample / max(progress.total_samples, 1) * text_length)
@@ -0,0 +1,102 @@
+"""AivisSpeech Engine の代わりに使う動作確認用のスタブ
+
+/version, /initialize_speaker, /audio_query, /synthesis だけを実装し、1文字を1モーラとして
+正弦波の WAV を返す。エンジンプールの振り分けや障害時の切り替えを試すときに使う。
+
+    python stub_engine.py --port 10102 --delay 0.5
+"""
+import io
+import wave
+import asyncio
+import argparse
+
+import numpy as np
+from aiohttp import web
+
+SAMPLE_RATE = 44100
+MORA_LENGTH = 0.1
+# 読点などでアクセント句を区切る文字
+_PAUSES = set("、。，,！？!?")
+
+
+def make_query(text: str) -> dict:
+    phrases = []
+    moras = []
+    for ch in text:
+        if ch in _PAUSES:
+            if moras:
+                phrases.append({
+                    "moras": moras,
+                    "accent": 1,
+                    "pause_mora": {"text": "、", "vowel": "pau", "vowel_length": 0.2, "pitch": 0.0},
+                })
+                moras = []
+            continue
+        moras.append({"text": ch, "consonant_length": None, "vowel": "a", "vowel_length": MORA_LENGTH, "pitch": 5.0})
+    if moras:
+        phrases.append({"moras": moras, "accent": 1, "pause_mora": None})
+    return {
+        "accent_phrases": phrases,
+        "speedScale": 1.0,
+        "pitchScale": 0.0,
+        "intonationScale": 1.0,
+        "volumeScale": 1.0,
+        "prePhonemeLength": 0.1,
+        "postPhonemeLength": 0.1,
+        "outputSamplingRate": SAMPLE_RATE,
+        "outputStereo": False,
+        "kana": text,
+    }
+
+
+def render(query: dict) -> bytes:
+    rate = query.get("outputSamplingRate", SAMPLE_RATE)
+    scale = 1.0 / (query.get("speedScale") or 1.0)
+    seconds = query.get("prePhonemeLength", 0.0) + query.get("postPhonemeLength", 0.0)
+    for phrase in query["accent_phrases"]:
+        for mora in phrase["moras"]:
+            seconds += (mora.get("consonant_length") or 0.0) + (mora.get("vowel_length") or 0.0)
+        if phrase.get("pause_mora"):
+            seconds += phrase["pause_mora"].get("vowel_length") or 0.0
+    t = np.arange(int(seconds * scale * rate)) / rate
+    pcm = (np.sin(2 * np.pi * 440 * t) * 3000).astype("<i2")
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def create_app(delay: float = 0.0) -> web.Application:
+    async def version(request):
+        return web.json_response("0.0.0-stub")
+
+    async def initialize_speaker(request):
+        return web.Response(status=204)
+
+    async def audio_query(request):
+        return web.json_response(make_query(request.query["text"]))
+
+    async def synthesis(request):
+        query = await request.json()
+        if delay:
+            await asyncio.sleep(delay)
+        return web.Response(body=render(query), content_type="audio/wav")
+
+    app = web.Application()
+    app.router.add_get("/version", version)
+    app.router.add_post("/initialize_speaker", initialize_speaker)
+    app.router.add_post("/audio_query", audio_query)
+    app.router.add_post("/synthesis", synthesis)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AivisSpeech Engine のスタブ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=10102)
+    parser.add_argument("--delay", type=float, default=0.0, help="/synthesis の応答を遅らせる秒数")
+    args = parser.parse_args()
+    web.run_app(create_app(args.delay), host=args.host, port=args.port)
@@ -0,0 +1,305 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+# メモリキャッシュの上限（バイト）
+SYNTHESIS_CACHE_BYTES = int(os.getenv("SYNTHESIS_CACHE_BYTES", str(64 * 1024 * 1024)))
+# ディスクキャッシュの上限（バイト、0で無制限）
+SYNTHESIS_CACHE_DISK_BYTES = int(os.getenv("SYNTHESIS_CACHE_DISK_BYTES", str(512 * 1024 * 1024)))
+# ディスクキャッシュの保存先（空文字で無効）
+SYNTHESIS_CACHE_DIR = os.getenv(
+    "SYNTHESIS_CACHE_DIR", os.path.join(os.path.dirname(__file__), ".cache", "synthesis")
+).strip()
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用にテキストを正規化する（全角半角の統一と空白の整理）"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def make_key(text: str, speaker: int, query_params: Optional[dict] = None) -> str:
+    """(テキスト, 話者, クエリパラメータ) からキャッシュキーを作る"""
+    payload = json.dumps(
+        {
+            "text": normalize_text(text),
+            "speaker": speaker,
+            "params": query_params or {},
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SynthesisCache:
+    """合成済み PCM（int16）の2段キャッシュ
+
+    メモリ上はバイト数上限つきの LRU、あふれた分はディスクに残る。
+    ディスク側も disk_max_bytes を超えたら更新日時の古いものから消す（読んだものは日時を更新する）。
+    ファイルの読み書きは get_entry_async() / put() ではイベントループの外（executor）で行う。
+    返す配列は共有されるため読み取り専用。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = SYNTHESIS_CACHE_BYTES,
+        directory: str = SYNTHESIS_CACHE_DIR,
+        disk_max_bytes: int = SYNTHESIS_CACHE_DISK_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, Optional[dict]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # ディスク上の合計サイズ（起動時に数え、以降は書き込みと削除で増減させる）
+        self._disk_lock = threading.Lock()
+        self._disk_bytes: Optional[int] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_bytes = self._scan_disk_bytes()
+            if self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    def _path(self, key: str, suffix: str = ".pcm") -> str:
+        return os.path.join(self.directory, key[:2], f"{key}{suffix}")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        return self.get_entry(key)[0]
+
+    def _get_memory(self, key: str) -> Optional[Tuple[np.ndarray, Optional[dict]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def get_entry(self, key: str) -> Tuple[Optional[np.ndarray], Optional[dict]]:
+        """(音声, 付帯情報) を返す（見つからなければ (None, None)）"""
+        entry = self._get_memory(key)
+        if entry is not None:
+            return entry
+        return self._get_disk(key)
+
+    async def get_entry_async(self, key: str) -> Tuple[Optional[np.ndarray], Optional[dict]]:
+        """get_entry() と同じ（ディスクの読み込みはイベントループを止めないよう executor で行う）"""
+        entry = self._get_memory(key)
+        if entry is not None:
+            return entry
+        if not self.directory:
+            return self._get_disk(key)
+        return await asyncio.get_event_loop().run_in_executor(None, self._get_disk, key)
+
+    def _get_disk(self, key: str) -> Tuple[Optional[np.ndarray], Optional[dict]]:
+        if self.directory:
+            path = self._path(key)
+            try:
+                audio = np.fromfile(path, dtype=np.int16)
+                # 読んだものは消されにくくする
+                os.utime(path)
+            except OSError:
+                audio = None
+            if audio is not None:
+                meta = None
+                meta_path = self._path(key, ".json")
+                if os.path.exists(meta_path):
+                    with open(meta_path, encoding="utf-8") as f:
+                        meta = json.load(f)
+                audio = self._remember(key, audio, meta)
+                with self._lock:
+                    self.disk_hits += 1
+                return audio, meta
+
+        with self._lock:
+            self.misses += 1
+        return None, None
+
+    def put(self, key: str, audio: np.ndarray, meta: Optional[dict] = None) -> np.ndarray:
+        """キャッシュに登録し、共有用の読み取り専用配列を返す
+
+        meta には文字表示用のタイミング索引など、音声に付随する小さな情報を入れる。
+        イベントループの中から呼ばれた場合、ディスクへの書き込みは executor で後から行う。
+        """
+        audio = self._remember(key, audio, meta)
+        if self.directory:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._store(key, audio, meta)
+            else:
+                future = loop.run_in_executor(None, self._store, key, audio, meta)
+                future.add_done_callback(self._stored)
+        return audio
+
+    @staticmethod
+    def _stored(future: "asyncio.Future") -> None:
+        # 書き込みの失敗を握りつぶさずに記録する
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to write synthesis cache: {future.exception()!r}")
+
+    def _store(self, key: str, audio: np.ndarray, meta: Optional[dict]) -> None:
+        try:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            written = audio.nbytes
+            if meta is not None:
+                data = json.dumps(meta).encode("utf-8")
+                self._write(self._path(key, ".json"), data)
+                written += len(data)
+            # 書きかけのファイルを読まないよう一時ファイルから置き換える
+            self._write(path, audio.tobytes())
+        except OSError as e:
+            print(f"Failed to write synthesis cache: {e}")
+            return
+        with self._disk_lock:
+            self._disk_bytes += written
+            if self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk()
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _disk_files(self):
+        """ディスク上の (更新日時, サイズ, 音声のパス) の一覧（付帯情報のサイズも含める）"""
+        files = []
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith(".pcm"):
+                    continue
+                try:
+                    stat = entry.stat()
+                    size = stat.st_size
+                    meta_path = entry.path[:-len(".pcm")] + ".json"
+                    if os.path.exists(meta_path):
+                        size += os.path.getsize(meta_path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, size, entry.path))
+        return files
+
+    def _scan_disk_bytes(self) -> int:
+        return sum(size for _, size, _ in self._disk_files())
+
+    def _evict_disk(self) -> None:
+        """更新日時の古いものから消して、上限の9割まで減らす"""
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in files:
+            if total <= target:
+                break
+            for victim in (path, path[:-len(".pcm")] + ".json"):
+                try:
+                    os.remove(victim)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Failed to evict synthesis cache: {e}")
+            total -= size
+            self.disk_evictions += 1
+        self._disk_bytes = total
+
+    def _remember(self, key: str, audio: np.ndarray, meta: Optional[dict] = None) -> np.ndarray:
+        audio.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[0].nbytes
+            self._entries[key] = (audio, meta)
+            self._bytes += audio.nbytes
+            # 上限を超えたら古いものから捨てる（ディスク側には残る）
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return audio
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_bytes": self._disk_bytes,
+                "disk_evictions": self.disk_evictions,
+            }
+
+
+class SingleFlight:
+    """同じキーの同時リクエストを1回の処理にまとめる
+
+    処理中のキーに対する呼び出しは、新たに処理を始めずに同じ結果を待つ。
+    待っている呼び出しがすべて取り消された場合だけ処理も取り消す。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, list] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def run(self, key: str, factory: Callable[[], Awaitable]):
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(factory())
+            entry = [task, 0]
+            self._inflight[key] = entry
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and entry[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def stats(self) -> dict:
+        return {
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+        }
+
+
+_cache: Optional[SynthesisCache] = None
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_cache() -> SynthesisCache:
+    """プロセス共有のキャッシュを返す"""
+    global _cache
+    if _cache is None:
+        _cache = SynthesisCache()
+    return _cache
+
+
+def get_single_flight() -> SingleFlight:
+    """合成リクエストをまとめるプロセス共有のオブジェクトを返す"""
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight()
+    return _single_flight
@@ -0,0 +1,69 @@
+import os
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+
+# 合成する音声のサンプルレート（空ならエンジンの既定値。24000 にすると転送量とキャッシュが約半分になる）
+AUDIO_SAMPLE_RATE = os.getenv("AUDIO_SAMPLE_RATE", "").strip()
+# サンプルレートが分からないときに使う値（AivisSpeech Engine の既定値）
+DEFAULT_SAMPLE_RATE = 44100
+
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+@dataclass
+class WavAudio:
+    """WAV から取り出した PCM（int16・モノラル）とサンプルレート"""
+    samples: np.ndarray
+    sample_rate: int
+
+
+def query_overrides() -> dict:
+    """/audio_query の結果に上書きする出力形式（モノラル固定、サンプルレートは設定があれば）"""
+    overrides = {"outputStereo": False}
+    if AUDIO_SAMPLE_RATE:
+        overrides["outputSamplingRate"] = int(AUDIO_SAMPLE_RATE)
+    return overrides
+
+
+def parse_wav(data) -> WavAudio:
+    """WAV のバイト列を解析し、data チャンクを指す int16 配列を返す
+
+    ヘッダはチャンクを順にたどって読み、サンプルはコピーせずに元のバッファを参照する
+    （返す配列は読み取り専用）。ステレオの場合だけ左右を平均したモノラルの配列を作る。
+    """
+    view = memoryview(data)
+    if len(view) < 12 or view[0:4] != b"RIFF" or view[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE file")
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        (size,) = struct.unpack_from("<I", view, offset + 4)
+        body = offset + 8
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HHIIHH", view, body)
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("WAV data chunk appears before fmt chunk")
+            # ストリーミングで書かれた WAV はサイズが正しくないことがあるので残りの長さで切る
+            size = min(size, len(view) - body)
+            return _to_wav_audio(view, body, size, fmt)
+        # チャンクは2バイト境界にそろえられている
+        offset = body + size + (size & 1)
+    raise ValueError("WAV data chunk not found")
+
+
+def _to_wav_audio(view: memoryview, offset: int, size: int, fmt) -> WavAudio:
+    format_tag, channels, sample_rate, _, _, bits = fmt
+    if format_tag not in (_WAVE_FORMAT_PCM, _WAVE_FORMAT_EXTENSIBLE) or bits != 16:
+        raise ValueError(f"unsupported WAV format (format={format_tag}, bits={bits})")
+    frame_bytes = 2 * channels
+    count = size // frame_bytes * channels
+    samples = np.frombuffer(view, dtype="<i2", count=count, offset=offset)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return WavAudio(samples, sample_rate)
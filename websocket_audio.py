@@ -0,0 +1,154 @@
+import os
+import json
+import struct
+import asyncio
+from typing import Dict, Optional
+
+import numpy as np
+
+from speech import AudioProgress, SynthesisStream, SynthesizedSpeech
+from wav_format import DEFAULT_SAMPLE_RATE
+
+# 音声の再生先: "local"（サーバーのスピーカー）または "websocket"（ブラウザへ送信）
+AUDIO_DELIVERY = os.getenv("AUDIO_DELIVERY", "local").strip()
+# 1フレームで送るサンプル数
+WEBSOCKET_AUDIO_FRAME_SAMPLES = int(os.getenv("WEBSOCKET_AUDIO_FRAME_SAMPLES", "8192"))
+
+
+# クライアントが送るフレームの種類
+CLIENT_MESSAGE_TYPES = ("message", "stop", "progress", "ended")
+
+
+def parse_client_message(raw: str) -> Optional[dict]:
+    """クライアントからのテキストフレームを解釈する（不正なフレームは None）
+
+    クライアントが送る {"type": ...} の形の JSON だけを制御メッセージとし、
+    それ以外のテキストは JSON であってもそのまま発言として扱う。
+    発言（type が message）は content が文字列でなければ不正とする。
+    """
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or data.get("type") not in CLIENT_MESSAGE_TYPES:
+        return {"type": "message", "content": raw}
+    if data["type"] == "message" and not isinstance(data.get("content"), str):
+        return None
+    return data
+
+
+class WebSocketAudioSink:
+    """合成した PCM をバイナリメッセージでクライアントへ送る再生先
+
+    発話ごとに audio_start / バイナリフレーム / audio_end を送り、
+    クライアントから返ってくる progress / ended で AudioProgress を進める。
+    バイナリフレームは先頭4バイトが発話 ID（リトルエンディアン）で、残りが int16 PCM。
+    サンプルレートは発話ごとに audio_start で伝える（sample_rate は配列だけを渡されたときの値）。
+    """
+
+    def __init__(self, websocket, sample_rate: int = DEFAULT_SAMPLE_RATE):
+        self.websocket = websocket
+        self.sample_rate = sample_rate
+        self._next_id = 1
+        self._progress: Dict[int, AudioProgress] = {}
+        self._senders = set()
+
+    async def play(self, audio_data) -> AudioProgress:
+        """音声の送信を始めて進行状況を返す（再生位置はクライアントの報告で進む）"""
+        utterance_id = self._next_id
+        self._next_id += 1
+
+        timeline = None
+        sample_rate = self.sample_rate
+        if isinstance(audio_data, SynthesizedSpeech):
+            audio_data, timeline, sample_rate = audio_data.audio, audio_data.timeline, audio_data.sample_rate
+        if isinstance(audio_data, SynthesisStream):
+            total = audio_data.estimated_samples
+            timeline = audio_data.timeline
+            sample_rate = audio_data.sample_rate
+        else:
+            total = len(audio_data)
+        progress = AudioProgress(total_samples=max(total, 1), timeline=timeline)
+        self._progress[utterance_id] = progress
+
+        await self.websocket.send_json(
+            {"type": "audio_start", "id": utterance_id, "sample_rate": sample_rate}
+        )
+        if isinstance(audio_data, SynthesisStream):
+            # 分割合成はチャンクが届くたびに送る
+            sender = asyncio.ensure_future(self._send_stream(utterance_id, audio_data, progress))
+            self._senders.add(sender)
+            sender.add_done_callback(self._senders.discard)
+        else:
+            await self._send_pcm(utterance_id, audio_data)
+            await self.websocket.send_json({"type": "audio_end", "id": utterance_id})
+        return progress
+
+    async def _send_stream(self, utterance_id, stream, progress) -> None:
+        sent = 0
+
+        async def send(chunk):
+            nonlocal sent
+            await self._send_pcm(utterance_id, chunk)
+            sent += len(chunk)
+
+        try:
+            await stream.drain(send)
+        finally:
+            progress.total_samples = max(sent, 1)
+            try:
+                await self.websocket.send_json({"type": "audio_end", "id": utterance_id})
+            except Exception:
+                pass
+
+    async def _send_pcm(self, utterance_id, audio_data) -> None:
+        header = struct.pack("<I", utterance_id)
+        step = WEBSOCKET_AUDIO_FRAME_SAMPLES
+        for i in range(0, len(audio_data), step):
+            frame = np.ascontiguousarray(audio_data[i:i + step], dtype="<i2")
+            await self.websocket.send_bytes(header + frame.tobytes())
+
+    def handle_client_message(self, message: dict) -> bool:
+        """progress / ended を処理する（処理した場合は True）"""
+        if message["type"] not in ("progress", "ended"):
+            return False
+        # 不正な値のフレームは無視する（接続は切らない）
+        utterance_id = message.get("id")
+        if not isinstance(utterance_id, int) or isinstance(utterance_id, bool):
+            return True
+        progress = self._progress.get(utterance_id)
+        if progress is None:
+            return True
+        if message["type"] == "progress":
+            sample = message.get("sample", 0)
+            if isinstance(sample, bool):
+                return True
+            try:
+                sample = int(sample)
+            except (TypeError, ValueError, OverflowError):
+                return True
+            progress.update(max(0, min(sample, progress.total_samples)))
+        else:
+            self._progress.pop(utterance_id, None)
+            progress.update(progress.total_samples)
+            progress.finish()
+        return True
+
+    def stop(self) -> None:
+        """送信中の音声を打ち切り、クライアントにも再生を止めさせる"""
+        self.close()
+        asyncio.ensure_future(self._send_stop())
+
+    async def _send_stop(self) -> None:
+        try:
+            await self.websocket.send_json({"type": "audio_stop"})
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        """接続終了時に、待っている進行状況をすべて終了扱いにする"""
+        for sender in list(self._senders):
+            sender.cancel()
+        for progress in self._progress.values():
+            progress.finish()
+        self._progress.clear()